@@ -0,0 +1,95 @@
+import os
+import time
+import hashlib
+import asyncio
+import argparse
+import itertools
+from typing import AsyncIterator
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.backends import default_backend
+from src.deezer import *
+
+
+def encrypt_deezer_track_file(track_id: str, data: bytes, secret: bytes) -> bytes:
+    md5 = hashlib.md5(track_id.encode()).hexdigest().encode()
+    key = bytes(t[0] ^ t[1] ^ t[2] for t in zip(secret, md5[:16], md5[16:]))
+    cipher = Cipher(algorithms.Blowfish(key), modes.CBC(bytes(range(8))), backend=default_backend())
+
+    output = bytearray(data)
+    for o in range(0, len(data) - DEEZER_TRACK_FILE_BLOCK_SIZE + 1, DEEZER_TRACK_FILE_BLOCK_SIZE * DEEZER_TRACK_FILE_STRIPE):
+        encryptor = cipher.encryptor()
+        output[o:o + DEEZER_TRACK_FILE_BLOCK_SIZE] = encryptor.update(data[o:o + DEEZER_TRACK_FILE_BLOCK_SIZE]) + encryptor.finalize()
+    return bytes(output)
+
+
+async def legacy_decrypt_deezer_track_file_http_stream(track_id: str, stream: aiohttp.StreamReader, secret: bytes) -> AsyncIterator[bytes]:
+    md5 = hashlib.md5(track_id.encode()).hexdigest().encode()
+    key = bytes(t[0] ^ t[1] ^ t[2] for t in zip(secret, md5[:16], md5[16:]))
+    iv = bytes(range(8))
+    cipher = Cipher(algorithms.Blowfish(key), modes.CBC(iv), backend=default_backend())
+
+    for i in itertools.count():
+        try:
+            chunk = await stream.readexactly(2048)
+            if i % 3 == 0:
+                decryptor = cipher.decryptor()
+                chunk = decryptor.update(chunk) + decryptor.finalize()
+            yield chunk
+        except asyncio.IncompleteReadError as e:
+            yield e.partial
+            break
+
+
+class MemoryStreamReader:
+    def __init__(self, data: bytes, chunk_size: int):
+        self._data = memoryview(data)
+        self._chunk_size = chunk_size
+        self._offset = 0
+
+    async def read(self, n: int = -1) -> bytes:
+        n = self._chunk_size if n < 0 else min(n, self._chunk_size)
+        data = bytes(self._data[self._offset:self._offset + n])
+        self._offset += len(data)
+        return data
+
+    async def readexactly(self, n: int) -> bytes:
+        data = bytes(self._data[self._offset:self._offset + n])
+        self._offset += len(data)
+        if len(data) < n:
+            raise asyncio.IncompleteReadError(data, n)
+        return data
+
+
+async def run(decrypt, track_id: str, data: bytes, secret: bytes, chunk_size: int) -> tuple[float, bytes]:
+    output = hashlib.md5()
+    start = time.perf_counter()
+    async for chunk in decrypt(track_id, MemoryStreamReader(data, chunk_size), secret):
+        output.update(chunk)
+    return time.perf_counter() - start, output.digest()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=64, help='track file size in MB')
+    parser.add_argument('--chunk-size', type=int, default=64, help='upstream read size in KB')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    track_id = '3135556'
+    secret = os.urandom(16)
+    data = os.urandom(args.size * 1024 * 1024)
+    encrypted = encrypt_deezer_track_file(track_id, data, secret)
+    expected = hashlib.md5(data).digest()
+
+    for name, decrypt in (('legacy', legacy_decrypt_deezer_track_file_http_stream), ('batched', decrypt_deezer_track_file_http_stream)):
+        elapsed = []
+        for _ in range(args.repeat):
+            seconds, digest = await run(decrypt, track_id, encrypted, secret, args.chunk_size * 1024)
+            if digest != expected:
+                raise Exception(name)
+            elapsed.append(seconds)
+        print(f'{name:>8}: {args.size / min(elapsed):8.1f} MB/s')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,251 @@
+import os
+import io
+import time
+import json
+import hashlib
+import asyncio
+import argparse
+from collections import OrderedDict
+from aiohttp import web
+from PIL import Image
+from .decryption import encrypt_deezer_track_file
+
+
+def create_flac_file(size: int) -> bytes:
+    streaminfo = (4096).to_bytes(2, 'big') * 2 + bytes(6) + ((44100 << 44) | (1 << 41) | (15 << 36) | 44100 * 200).to_bytes(8, 'big') + bytes(16)
+    vorbis_comment = (6).to_bytes(4, 'little') + b'fake  ' + bytes(4)
+    header = b'fLaC'
+    header += bytes([0]) + len(streaminfo).to_bytes(3, 'big') + streaminfo
+    header += bytes([4]) + len(vorbis_comment).to_bytes(3, 'big') + vorbis_comment
+    header += bytes([0x81]) + (8192).to_bytes(3, 'big') + bytes(8192)
+    return header + os.urandom(max(size - len(header), 0))
+
+
+def create_mp3_file(size: int) -> bytes:
+    frame = b'\xff\xfb\x90\x00' + bytes(413)
+    header = b'ID3\x03\x00\x00' + bytes([0, 0, 0, 20]) + bytes(20)
+    return header + frame * max((size - len(header)) // len(frame), 1)
+
+
+class FakeDeezer:
+    # Stand-in for the parts of Deezer used by deezl: a catalog of `track_count` tracks in albums of `album_size`
+    # tracks, playlists of `playlist_size` tracks, the gateway, public API, get_url, track file CDN and image CDN.
+    # Every request waits `latency` seconds, response bodies are sent at `bandwidth` bytes per second per connection.
+    FILE_FORMATS = ('FLAC', 'MP3_320', 'MP3_128')
+
+    def __init__(self, secret: bytes, latency: float = 0, bandwidth: float | None = None, track_count: int = 10000, album_size: int = 12, playlist_size: int = 50, flac_size: int = 1024 ** 2 * 8, mp3_size: int = 1024 ** 2 * 3, file_cache_size: int = 16):
+        self._secret = secret
+        self._latency = latency
+        self._bandwidth = bandwidth
+        self._track_count = track_count
+        self._album_size = album_size
+        self._playlist_size = playlist_size
+        self._files = {'FLAC': create_flac_file(flac_size), 'MP3_320': create_mp3_file(mp3_size), 'MP3_128': create_mp3_file(mp3_size * 2 // 5)}
+        self._encrypted_files = OrderedDict()
+        self._file_cache_size = file_cache_size
+        self._images = {}
+
+        self.requests = {}
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_route('*', '/{path:.*}', self._handle)
+        return app
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        await asyncio.sleep(self._latency)
+        return await handler(request)
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        host = request.host.partition(':')[0]
+        match host, request.path:
+            case 'www.deezer.com', '/ajax/gw-light.php':
+                call = request.query['method']
+                results = self._call_gateway(call, await request.json())
+                response = web.json_response(dict(error=[] if results is not None else dict(GATEWAY_ERROR=call), results=results))
+            case 'api.deezer.com', path:
+                call = 'api'
+                response = web.json_response(self._call_api(path))
+            case 'media.deezer.com', '/v1/get_url':
+                call = 'get_url'
+                response = web.json_response(self._get_url(await request.json()))
+            case _, path if path.startswith('/images/'):
+                call = 'image'
+                response = await self._send(request, self._get_image(path))
+            case _, path if path.startswith('/media/'):
+                call = 'track'
+                response = await self._send(request, self._get_track_file(path))
+            case _:
+                raise web.HTTPNotFound()
+
+        self.requests[call] = self.requests.get(call, 0) + 1
+        return response
+
+    async def _send(self, request: web.Request, data: bytes) -> web.StreamResponse:
+        start, stop = 0, len(data)
+        if 'Range' in request.headers:
+            http_range = request.http_range
+            start, stop = http_range.start or 0, len(data) if http_range.stop is None else min(http_range.stop, len(data))
+            if start < 0:
+                start, stop = len(data) + start, len(data)
+
+        response = web.StreamResponse(status=206 if 'Range' in request.headers else 200)
+        response.content_length = stop - start
+        if response.status == 206:
+            response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{len(data)}'
+        await response.prepare(request)
+
+        chunk_size = 1024 * 64
+        for i in range(start, stop, chunk_size):
+            await response.write(data[i:min(i + chunk_size, stop)])
+            if self._bandwidth is not None:
+                await asyncio.sleep(min(chunk_size, stop - i) / self._bandwidth)
+        await response.write_eof()
+        return response
+
+    def _md5(self, value: str) -> str:
+        return hashlib.md5(value.encode()).hexdigest()
+
+    def track(self, id_: int) -> dict:
+        album_id = (id_ - 1) // self._album_size + 1
+        return {
+            'SNG_ID': str(id_),
+            'SNG_TITLE': f'Track {id_}',
+            'VERSION': '',
+            'ARTISTS': [{'ART_ID': str(album_id % 97 + 1), 'ART_NAME': f'Artist {album_id % 97 + 1}', 'ROLE_ID': '0', 'ARTISTS_SONGS_ORDER': '0'}],
+            'ALB_ID': str(album_id),
+            'ALB_TITLE': f'Album {album_id}',
+            'ALB_PICTURE': self._md5(f'album-{album_id}'),
+            'DISK_NUMBER': '1',
+            'TRACK_NUMBER': str((id_ - 1) % self._album_size + 1),
+            'DURATION': '200',
+            'PHYSICAL_RELEASE_DATE': '2020-01-01',
+            'SNG_CONTRIBUTORS': {'composer': [f'Composer {id_ % 13}']},
+            'COPYRIGHT': '(C) 2020 Fake',
+            'ISRC': f'FAKE{id_:08}',
+            'EXPLICIT_LYRICS': '0',
+            'MD5_ORIGIN': self._md5(f'track-{id_}'),
+            'MEDIA_VERSION': '1',
+            'TRACK_TOKEN': f'token-{id_}',
+            'MEDIA': [{'TYPE': 'preview', 'HREF': f'https://cdns-preview-0.dzcdn.net/stream/{id_}.mp3'}],
+            **{f'FILESIZE_{f}': str(len(self._files[f])) for f in self.FILE_FORMATS},
+        }
+
+    def album(self, id_: int) -> dict:
+        return {
+            'ALB_ID': str(id_),
+            'ALB_TITLE': f'Album {id_}',
+            'ARTISTS': [{'ART_ID': str(id_ % 97 + 1), 'ART_NAME': f'Artist {id_ % 97 + 1}', 'ARTISTS_ALBUMS_ORDER': '0'}],
+            'ALB_PICTURE': self._md5(f'album-{id_}'),
+            'NUMBER_TRACK': str(self._album_size),
+            'PHYSICAL_RELEASE_DATE': '2020-01-01',
+            'LABEL_NAME': 'Fake',
+            'UPC': f'{id_:011}',
+        }
+
+    def album_tracks(self, id_: int) -> list[dict]:
+        return [self.track(i) for i in range((id_ - 1) * self._album_size + 1, min(id_ * self._album_size, self._track_count) + 1)]
+
+    def playlist(self, id_: int) -> dict:
+        return {
+            'PLAYLIST_ID': str(id_),
+            'TITLE': f'Playlist {id_}',
+            'PARENT_USERNAME': 'fake',
+            'PARENT_USER_ID': '1',
+            'NB_SONG': str(self._playlist_size),
+            'DURATION': str(self._playlist_size * 200),
+            'DATE_MOD': '2020-01-01 00:00:00',
+            'PLAYLIST_PICTURE': self._md5(f'playlist-{id_}'),
+            'PICTURE_TYPE': 'playlist',
+        }
+
+    def playlist_tracks(self, id_: int) -> list[dict]:
+        return [self.track(((id_ - 1) * self._playlist_size + i) % self._track_count + 1) for i in range(self._playlist_size)]
+
+    def _call_gateway(self, method: str, data: dict) -> dict | None:
+        match method:
+            case 'deezer.getUserData':
+                return {'checkForm': 'fake', 'USER': {'USER_ID': '1', 'OPTIONS': {'license_token': 'fake'}}}
+            case 'deezer.pageTrack':
+                return {'DATA': self.track(int(data['SNG_ID']))}
+            case 'song.getListData':
+                return {'data': [self.track(int(i)) for i in data['SNG_IDS'] if 0 < int(i) <= self._track_count]}
+            case 'deezer.pageAlbum':
+                return {'DATA': self.album(int(data['ALB_ID'])), 'SONGS': {'data': self.album_tracks(int(data['ALB_ID']))}}
+            case 'deezer.pagePlaylist':
+                tracks = self.playlist_tracks(int(data['PLAYLIST_ID']))
+                tracks = tracks[data['start']:] if data['nb'] < 0 else tracks[data['start']:data['start'] + data['nb']]
+                return {'DATA': self.playlist(int(data['PLAYLIST_ID'])), 'SONGS': {'data': tracks, 'count': len(tracks), 'total': self._playlist_size}}
+            case 'search.music':
+                ids = [(int(self._md5(data['query']), 16) + i) % self._track_count + 1 for i in range(data['start'], data['start'] + data['nb'])]
+                match data['output']:
+                    case 'TRACK':
+                        results = [self.track(i) for i in ids]
+                    case 'ALBUM':
+                        results = [self.album((i - 1) // self._album_size + 1) for i in ids]
+                    case 'PLAYLIST':
+                        results = [self.playlist(i) for i in ids]
+                return {'data': results, 'total': self._track_count, 'next': data['start'] + data['nb']}
+        return None
+
+    def _call_api(self, path: str) -> dict:
+        match path.strip('/').split('/'):
+            case ['auth', 'token']:
+                return {'access_token': 'fake', 'expires': 3600}
+            case ['2.0', 'track', id_]:
+                return {'id': int(id_), 'title': f'Track {id_}', 'bpm': 120.0, 'gain': -8.5}
+            case _:
+                return {}
+
+    def _get_url(self, data: dict) -> dict:
+        formats = [f['format'] for f in data['media'][0]['formats']]
+        format_ = next((f for f in formats if f in self.FILE_FORMATS), None)
+        return {'data': [
+            {'media': [{'format': format_, 'exp': int(time.time()) + 3600, 'sources': [{'url': f'https://e-cdns-proxy-0.dzcdn.net/media/1/{t.removeprefix("token-")}/{format_}', 'provider': 'ak'}]}]}
+            if format_ is not None else {'errors': [{'code': 2002, 'message': 'Track token has no sufficient rights on requested media'}]}
+            for t in data['track_tokens']]}
+
+    def _get_track_file(self, path: str) -> bytes:
+        _, _, _, id_, format_ = path.split('/')
+        if (data := self._encrypted_files.get((id_, format_))) is None:
+            data = self._encrypted_files[(id_, format_)] = encrypt_deezer_track_file(id_, self._files[format_], self._secret)
+            while len(self._encrypted_files) > self._file_cache_size:
+                self._encrypted_files.popitem(last=False)
+        self._encrypted_files.move_to_end((id_, format_))
+        return data
+
+    def _get_image(self, path: str) -> bytes:
+        _, _, type_, md5, name = path.split('/')
+        size = name.partition('-')[0]
+        format_ = name.rpartition('.')[2]
+        if (data := self._images.get((size, format_))) is None:
+            output = io.BytesIO()
+            Image.new('RGB', tuple(map(int, size.split('x'))), (int(md5[:2], 16), int(md5[2:4], 16), int(md5[4:6], 16))).save(output, format_.replace('jpg', 'jpeg'))
+            data = self._images[(size, format_)] = output.getvalue()
+        return data
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--secret', required=True, help='track decryption secret')
+    parser.add_argument('--latency', type=float, default=0, help='response latency in ms')
+    parser.add_argument('--bandwidth', type=float, default=None, help='throughput per connection in MB/s')
+    parser.add_argument('--playlist-size', type=int, default=50, help='tracks per playlist')
+    args = parser.parse_args()
+
+    fake = FakeDeezer(args.secret.encode(), args.latency / 1000, None if args.bandwidth is None else args.bandwidth * 1024 ** 2, playlist_size=args.playlist_size)
+    runner = web.AppRunner(fake.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port).start()
+    print(f'listening on http://127.0.0.1:{args.port}, run deezl with DEEZL_UPSTREAM_URL=http://127.0.0.1:{args.port}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(json.dumps(fake.requests))
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,48 @@
+import os
+import timeit
+import asyncio
+import argparse
+
+for name, value in dict(TRACK_DECRYPTION_SECRET='0' * 16, CLIENT_ID='fake', CLIENT_SECRET='fake', EMAIL='fake', PASSWORD_MD5='00' * 16).items():
+    os.environ.setdefault(f'DEEZL_{name}', value)
+
+from src.api import *
+from .decryption import encrypt_deezer_track_file, MemoryStreamReader
+from .fake_deezer import FakeDeezer
+
+
+def report(name: str, seconds: float, number: int, unit: str = 'call'):
+    print(f'{name:>24}: {seconds / number * 1e6:10.2f} us/{unit}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=10000)
+    parser.add_argument('--size', type=int, default=32, help='decrypted track file size in MB')
+    args = parser.parse_args()
+
+    fake = FakeDeezer(b'0' * 16, flac_size=1024, mp3_size=1024)
+    gateway_track = fake.track(1)
+    gateway_album = fake.album(1)
+    gateway_album_tracks = fake.album_tracks(1)
+    api_track = {'bpm': 120.0}
+    track = {**parse_track(gateway_track, api_track), 'album': parse_album(gateway_album, gateway_album_tracks)}
+
+    report('parse_track', timeit.timeit(lambda: parse_track(gateway_track, api_track), number=args.number), args.number)
+    report('parse_album', timeit.timeit(lambda: parse_album(gateway_album, gateway_album_tracks), number=args.number), args.number)
+    report('create_track_tags', timeit.timeit(lambda: create_track_tags(track), number=args.number), args.number)
+
+    data = os.urandom(args.size * 1024 ** 2)
+    encrypted = encrypt_deezer_track_file('1', data, b'0' * 16)
+
+    async def decrypt():
+        async for _ in decrypt_deezer_track_file_http_stream('1', MemoryStreamReader(encrypted, DEEZER_TRACK_FILE_BUFFER_SIZE), b'0' * 16):
+            pass
+
+    seconds = min(timeit.repeat(lambda: asyncio.run(decrypt()), number=1, repeat=3))
+    report('decryption', seconds, args.size, 'MB')
+    print(f'{"decryption":>24}: {args.size / seconds:10.2f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
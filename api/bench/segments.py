@@ -0,0 +1,89 @@
+import os
+import time
+import hashlib
+import asyncio
+import argparse
+from aiohttp import web
+from src.deezer import *
+from .decryption import encrypt_deezer_track_file
+
+
+def create_cdn(data: bytes, rate: float, latency: float) -> web.Application:
+    # Stand-in for the Deezer CDN: every connection is throttled to `rate` bytes per second.
+    async def handle(request: web.Request) -> web.StreamResponse:
+        await asyncio.sleep(latency)
+        start, stop = 0, len(data)
+        if (http_range := request.http_range) != slice(None, None, None):
+            start, stop = http_range.start or 0, len(data) if http_range.stop is None else min(http_range.stop, len(data))
+
+        response = web.StreamResponse(status=206 if 'Range' in request.headers else 200)
+        response.content_length = stop - start
+        if response.status == 206:
+            response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{len(data)}'
+        await response.prepare(request)
+
+        chunk_size = 1024 * 16
+        for i in range(start, stop, chunk_size):
+            await response.write(data[i:min(i + chunk_size, stop)])
+            await asyncio.sleep(min(chunk_size, stop - i) / rate)
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_get('/track', handle)
+    return app
+
+
+async def run_stream(session: aiohttp.ClientSession, url: str, track_id: str, secret: bytes) -> bytes:
+    output = hashlib.md5()
+    async with session.get(url) as response:
+        async for chunk in decrypt_deezer_track_file_http_stream(track_id, response.content, secret):
+            output.update(chunk)
+    return output.digest()
+
+
+async def run_segments(session: aiohttp.ClientSession, url: str, track_id: str, secret: bytes, segment_size: int, connections: int) -> bytes:
+    output = hashlib.md5()
+    async for data, _ in read_deezer_track_file_segments(session, url, track_id, secret, 0, None, segment_size, connections):
+        output.update(data)
+    return output.digest()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=40, help='track file size in MB')
+    parser.add_argument('--rate', type=float, default=8, help='CDN throughput per connection in MB/s')
+    parser.add_argument('--latency', type=float, default=30, help='CDN time to first byte in ms')
+    parser.add_argument('--segment-size', type=int, default=1024, help='segment size in KB')
+    parser.add_argument('--connections', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    track_id = '3135556'
+    secret = os.urandom(16)
+    data = os.urandom(args.size * 1024 * 1024)
+    expected = hashlib.md5(data).digest()
+
+    runner = web.AppRunner(create_cdn(encrypt_deezer_track_file(track_id, data, secret), args.rate * 1024 * 1024, args.latency / 1000))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port).start()
+    url = f'http://127.0.0.1:{args.port}/track'
+
+    runs = [('stream', lambda session: run_stream(session, url, track_id, secret))]
+    for connections in args.connections:
+        runs.append((f'{connections} x {args.segment_size} KB', lambda session, connections=connections: run_segments(session, url, track_id, secret, args.segment_size * 1024, connections)))
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            for name, run in runs:
+                start = time.perf_counter()
+                if await run(session) != expected:
+                    raise Exception(name)
+                seconds = time.perf_counter() - start
+                print(f'{name:>16}: {seconds:6.2f} s {args.size / seconds:8.1f} MB/s')
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
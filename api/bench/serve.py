@@ -0,0 +1,20 @@
+import argparse
+import uvicorn
+from src import api
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--no-rate-limits', action='store_true', help='lift the upstream rate limits, to measure deezl itself')
+    args = parser.parse_args()
+
+    if args.no_rate_limits:
+        for name in ('GATEWAY_LIMITS', 'API_LIMITS', 'TRACKS_LIMITS', 'IMAGES_LIMITS'):
+            setattr(api.DeezerClient, name, dict(max_rate=1000000, time_period=1))
+
+    uvicorn.run(api.app, host='127.0.0.1', port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
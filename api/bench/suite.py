@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import itertools
+import aiohttp
+from aiohttp import web
+from .fake_deezer import FakeDeezer
+
+
+SCENARIOS = {
+    'track': lambda i: f'/track/{i + 1}/download?format=FLAC&cover_format=jpg&cover_size=500x500',
+    'album': lambda i: f'/album/{i + 1}',
+    'playlist': lambda i: f'/playlist/{i + 1}',
+    'search': lambda i: f'/search?query=q{i}&type=track&index=0&limit=25',
+}
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def reset_peak_rss(pid: int):
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def read_peak_rss(pid: int) -> int | None:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            return next(int(l.split()[1]) * 1024 for l in f if l.startswith('VmHWM:'))
+    except (OSError, StopIteration):
+        return None
+
+
+async def start_server(port: int, upstream_url: str, secret: str, no_rate_limits: bool) -> asyncio.subprocess.Process:
+    env = dict(
+        os.environ,
+        DEEZL_TRACK_DECRYPTION_SECRET=secret,
+        DEEZL_CLIENT_ID='fake',
+        DEEZL_CLIENT_SECRET='fake',
+        DEEZL_EMAIL='fake',
+        DEEZL_PASSWORD_MD5='00' * 16,
+        DEEZL_UPSTREAM_URL=upstream_url)
+    args = [sys.executable, '-m', 'bench.serve', '--port', str(port), *(['--no-rate-limits'] if no_rate_limits else [])]
+    process = await asyncio.create_subprocess_exec(*args, env=env, cwd=os.path.dirname(os.path.dirname(__file__)))
+
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(f'http://127.0.0.1:{port}/stats') as response:
+                    if response.status == 200:
+                        return process
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    process.kill()
+    raise Exception('server did not start')
+
+
+async def run_level(session: aiohttp.ClientSession, base_url: str, paths, concurrency: int, count: int) -> dict:
+    latencies = []
+    errors = 0
+    size = 0
+    sent = 0
+
+    async def worker():
+        # Requests are counted when sent, so that exactly `count` are sent.
+        nonlocal errors, size, sent
+        while sent < count:
+            sent += 1
+            path = next(paths)
+            start = time.perf_counter()
+            try:
+                async with session.get(base_url + path) as response:
+                    body = await response.read()
+                    size += len(body)
+                    response.raise_for_status()
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    return dict(
+        requests=len(latencies),
+        errors=errors,
+        requests_per_second=len(latencies) / seconds,
+        megabytes_per_second=size / seconds / 1024 ** 2,
+        p50=percentile(latencies, 0.5) if latencies else None,
+        p99=percentile(latencies, 0.99) if latencies else None)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', choices=[*SCENARIOS], default=[*SCENARIOS])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=32, help='requests per concurrency level')
+    parser.add_argument('--latency', type=float, default=20, help='stand-in Deezer response latency in ms')
+    parser.add_argument('--bandwidth', type=float, default=None, help='stand-in Deezer throughput per connection in MB/s')
+    parser.add_argument('--flac-size', type=float, default=8, help='track file size in MB')
+    parser.add_argument('--playlist-size', type=int, default=50, help='tracks per playlist')
+    parser.add_argument('--rate-limits', action='store_true', help='keep the upstream rate limits')
+    parser.add_argument('--port', type=int, default=8700)
+    args = parser.parse_args()
+
+    secret = os.urandom(8).hex()
+    fake = FakeDeezer(secret.encode(), args.latency / 1000, None if args.bandwidth is None else args.bandwidth * 1024 ** 2, flac_size=int(args.flac_size * 1024 ** 2), playlist_size=args.playlist_size)
+    runner = web.AppRunner(fake.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port).start()
+
+    print(f'{"scenario":>10} {"conc":>5} {"reqs":>5} {"errs":>5} {"req/s":>8} {"MB/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"peak RSS MB":>12}')
+    try:
+        for scenario in args.scenarios:
+            process = await start_server(args.port + 1, f'http://127.0.0.1:{args.port}', secret, not args.rate_limits)
+            paths = map(SCENARIOS[scenario], itertools.count())
+            try:
+                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+                    for concurrency in args.concurrency:
+                        reset_peak_rss(process.pid)
+                        result = await run_level(session, f'http://127.0.0.1:{args.port + 1}', paths, concurrency, args.requests)
+                        rss = read_peak_rss(process.pid)
+                        print(
+                            f'{scenario:>10} {concurrency:>5} {result["requests"]:>5} {result["errors"]:>5} '
+                            f'{result["requests_per_second"]:>8.1f} {result["megabytes_per_second"]:>8.1f} '
+                            f'{(result["p50"] or 0) * 1000:>8.1f} {(result["p99"] or 0) * 1000:>8.1f} '
+                            f'{"n/a" if rss is None else f"{rss / 1024 ** 2:.1f}":>12}')
+            finally:
+                process.terminate()
+                await process.wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
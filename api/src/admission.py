@@ -0,0 +1,99 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+
+class MemoryBudgetExceeded(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__('memory budget exceeded')
+        self.retry_after = retry_after
+
+
+class MemoryBudget:
+    # Bounds the bytes held by downloads in progress. Reservations that do not fit wait in turn (first come, first
+    # served), rejectable ones are rejected when `max_queued` reservations are already waiting or after `timeout`
+    # seconds. Reservations larger than the budget are reduced to it, so that they can run alone.
+    def __init__(self, max_bytes: int, max_queued: int, timeout: float):
+        self._max_bytes = max_bytes
+        self._max_queued = max_queued
+        self._timeout = timeout
+        self._waiters = deque()
+
+        self.used = 0
+        self.max_used = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+
+    def stats(self) -> dict:
+        return dict(
+            max_bytes=self._max_bytes,
+            used=self.used,
+            max_used=self.max_used,
+            queued=len(self._waiters),
+            max_queued=self._max_queued,
+            admitted=self.admitted,
+            rejected=self.rejected,
+            mean_wait_seconds=self.wait_seconds / self.admitted if self.admitted else 0.0)
+
+    def check(self):
+        if len(self._waiters) >= self._max_queued:
+            self.rejected += 1
+            raise MemoryBudgetExceeded(self._timeout)
+
+    async def acquire(self, size: int, reject: bool = True) -> int:
+        # Returns the reserved size, to be released.
+        size = min(size, self._max_bytes)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+
+        if not self._waiters and self.used + size <= self._max_bytes:
+            self._take(size)
+        else:
+            if reject:
+                self.check()
+            waiter = (size, loop.create_future())
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter[1], self._timeout if reject else None)
+            except BaseException as e:
+                if waiter[1].done() and not waiter[1].cancelled():
+                    self.release(size)
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    self._grant()
+                if isinstance(e, asyncio.TimeoutError):
+                    self.rejected += 1
+                    raise MemoryBudgetExceeded(self._timeout) from None
+                raise
+
+        self.admitted += 1
+        self.wait_seconds += loop.time() - start
+        return size
+
+    def release(self, size: int):
+        self.used -= size
+        self._grant()
+
+    @asynccontextmanager
+    async def reserve(self, size: int, reject: bool = True) -> AsyncIterator[None]:
+        size = await self.acquire(size, reject)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+    def _take(self, size: int):
+        self.used += size
+        self.max_used = max(self.max_used, self.used)
+
+    def _grant(self):
+        while self._waiters:
+            size, future = self._waiters[0]
+            if not future.done():
+                if self.used + size > self._max_bytes:
+                    break
+                self._take(size)
+                future.set_result(None)
+            self._waiters.popleft()
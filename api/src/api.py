@@ -1,15 +1,74 @@
+import json
+import math
+import logging
+import mimetypes
+import time
+import hashlib
+import contextvars
 import datetime
-from contextlib import AsyncExitStack
+import functools
+import urllib.parse
+from typing import Awaitable, Callable, Literal
+from contextlib import AsyncExitStack, asynccontextmanager, aclosing
+from collections import OrderedDict, deque
+from http.cookies import SimpleCookie
 from io import BytesIO
-import mutagen
-from mutagen import flac, mp3, id3
+import orjson
 from PIL import Image
-from fastapi import FastAPI, Response
-from pydantic import BaseSettings
-from async_lru import alru_cache
-from aiolimiter import AsyncLimiter
+from fastapi import FastAPI, Request, Response, Body, Depends, Header, Path, Query
+from fastapi.responses import StreamingResponse, FileResponse, ORJSONResponse
+from pydantic import BaseModel, BaseSettings, Field
+from yarl import URL
 from .common import *
 from .deezer import *
+from .archive import *
+from .cache import *
+from .scheduler import *
+from .workers import *
+from .transport import *
+from .metrics import *
+from .jobs import *
+from .compression import *
+from .tags import *
+from .shared import *
+from .prefetch import *
+from .broadcast import *
+from .admission import *
+
+
+FORMATS = ['FLAC', 'MP3_320', 'MP3_256', 'MP3_128', 'MP3_64']
+TrackFormat = Literal[tuple(FORMATS)]
+FORMATS_EXTENSIONS = {'FLAC': 'flac', 'MP3_320': 'mp3', 'MP3_256': 'mp3', 'MP3_128': 'mp3', 'MP3_64': 'mp3'}
+
+TRACK_FILE_TAGS_VERSION = 2
+TRACKS_BATCH_SIZE = 100
+TRACKS_MAX_IDS = 1000
+TRACK_FILE_HEADERS_CACHE = dict(max_size=256, ttl=60 * 60)
+IMAGES_CACHE = dict(max_size=64, ttl=60 * 60)
+IMAGE_MASTERS_CACHE = dict(max_size=16, ttl=60 * 10)
+IMAGE_MASTER = dict(size=(1800, 1800), format='jpg')
+IMAGE_JPEG_QUALITY = 95
+PREFETCH = dict(max_tasks=16, timeout=60, max_tracks=50, max_covers=16)
+TRACK_FILE_BROADCAST = dict(max_buffer=1024 ** 2 * 8, timeout=10)
+TRACK_STREAM_MEMORY = TRACK_FILE_BROADCAST['max_buffer'] + 1024 ** 2 * 4  # chunks kept by a track file broadcast, plus tagged header, cover and chunks in flight
+UPSTREAM_TIMEOUT = dict(total=None, sock_connect=10, sock_read=60)
+UPSTREAM_TRANSPORT = dict(attempts=4, backoff=0.5, max_backoff=30, failure_threshold=5, reset_timeout=30)
+COMPRESSION = dict(minimum_size=1024, level=6)
+ARCHIVE_ERRORS_FILENAME = 'errors.txt'
+IMAGE_SIZE_REGEX = r'^\d+x\d+$'
+ImageFormat = Literal['jpg', 'png']
+
+logger = logging.getLogger(__name__)
+
+metrics_registry = MetricsRegistry()
+upstream_request_seconds = metrics_registry.register(Histogram('deezl_upstream_request_seconds', 'Upstream request latency until the response headers, retries included', ['call', 'method']))
+track_file_downloaded_bytes = metrics_registry.register(Counter('deezl_track_file_downloaded_bytes_total', 'Track file bytes downloaded from the CDN'))
+track_file_decrypted_bytes = metrics_registry.register(Counter('deezl_track_file_decrypted_bytes_total', 'Track file bytes decrypted'))
+track_file_decrypt_seconds = metrics_registry.register(Counter('deezl_track_file_decrypt_seconds_total', 'Time spent decrypting track files, worker pool queueing included'))
+track_file_processing_seconds = metrics_registry.register(Histogram('deezl_track_file_processing_seconds', 'Time spent processing covers and tagging track files', ['stage']))
+track_file_streams = metrics_registry.register(Counter('deezl_track_file_streams_total', 'Whole track file downloads, by whether they were started upstream, joined one in progress or fell back to their own', ['kind']))
+downloads_in_progress = metrics_registry.register(Gauge('deezl_downloads_in_progress', 'Downloads being streamed', ['type']))
+image_derivatives = metrics_registry.register(Counter('deezl_image_derivatives_total', 'Images read from the disk cache or made from a master image', ['source']))
 
 
 class DeezerClient:
@@ -17,86 +76,386 @@ class DeezerClient:
     API_LIMITS = dict(max_rate=5, time_period=1)
     TRACKS_LIMITS = dict(max_rate=1, time_period=2)
     IMAGES_LIMITS = dict(max_rate=1, time_period=2)
-    IMAGES_COOLDOWN = dict(cooldown=10, attempts=3)
-
-    def __init__(self, settings, session: aiohttp.ClientSession):
+    TRACK_PAGES_CACHE = dict(max_size=1024, ttl=60 * 10)
+    ALBUM_PAGES_CACHE = dict(max_size=256, ttl=60 * 10)
+    PLAYLIST_PAGES_CACHE = dict(max_size=64, ttl=60 * 2)
+    PLAYLIST_PAGE_SIZE = 500
+    PLAYLIST_PAGES_CONCURRENCY = 4
+    API_TRACKS_CACHE = dict(max_size=1024, ttl=60 * 60)
+    SEARCH_RESULTS_CACHE = dict(max_size=1024, ttl=60)
+    SEARCH_PREFETCH_CAPACITY = 2
+    PREFETCH_CAPACITY = 2
+    TRACK_FILE_URLS_BATCH = dict(delay=0.05, max_size=50)
+    TRACK_FILE_URLS_CACHE = dict(max_size=4096, expiry_margin=60)
+    LOGIN = dict(ttl=60 * 30, refresh=60 * 25, retry=30, lock_ttl=30)
+    TRACK_SEGMENTS_RETRY = dict(attempts=3, retry_delay=1)
+
+    def __init__(self, settings, account, session: aiohttp.ClientSession, workers: WorkerPool | None = None, shared_state: SharedState | None = None):
         self._settings = settings
-        self._password_md5 = bytes.fromhex(self._settings.password_md5)
+        self._email = account.email
+        self._password_md5 = bytes.fromhex(account.password_md5)
         self._track_decryption_secret = self._settings.track_decryption_secret.encode()
 
         self._session = session
+        self._workers = workers
+        self._shared_state = shared_state
+
+        # Rate limits, caches and the login session are per account, and shared with the other processes if there is a shared state.
+        key = self._shared_key = f'deezer:{self._email}'
+        self._gateway_rate_limiter = RateScheduler(**self.GATEWAY_LIMITS, shared_state=shared_state, key=f'{key}:gateway')
+        self._api_rate_limiter = RateScheduler(**self.API_LIMITS, shared_state=shared_state, key=f'{key}:api')
+        self._tracks_rate_limiter = RateScheduler(**self.TRACKS_LIMITS, shared_state=shared_state, key=f'{key}:tracks')
+        self._images_rate_limiter = RateScheduler(**self.IMAGES_LIMITS, shared_state=shared_state, key=f'{key}:images')
+
+        self._track_pages_cache = MemoryCache(**self.TRACK_PAGES_CACHE, shared_state=shared_state, namespace=f'{key}:track_pages')
+        self._album_pages_cache = MemoryCache(**self.ALBUM_PAGES_CACHE, shared_state=shared_state, namespace=f'{key}:album_pages')
+        self._playlist_pages_cache = MemoryCache(**self.PLAYLIST_PAGES_CACHE, shared_state=shared_state, namespace=f'{key}:playlist_pages')
+        self._api_tracks_cache = MemoryCache(**self.API_TRACKS_CACHE, shared_state=shared_state, namespace=f'{key}:api_tracks')
+        self._search_results_cache = MemoryCache(**self.SEARCH_RESULTS_CACHE, shared_state=shared_state, namespace=f'{key}:search_results')
+        self._search_prefetches = 0
 
-        self._gateway_rate_limiter = AsyncLimiter(**self.GATEWAY_LIMITS)
-        self._api_rate_limiter = AsyncLimiter(**self.API_LIMITS)
-        self._tracks_rate_limiter = AsyncLimiter(**self.TRACKS_LIMITS)
-        self._images_rate_limiter = AsyncLimiter(**self.IMAGES_LIMITS)
+        self._track_file_urls = OrderedDict()
+        self._track_file_urls_pending = {}
+        self._track_file_urls_batches = {}
+
+        self._tasks = set()
 
         self._last_login = None
+        self._login_time = None
         self._user = None
+        self._login_task = None
+        self._refresh_login_task = None
+
+    async def aclose(self):
+        for task in [*self._tasks, self._login_task, self._refresh_login_task]:
+            if task is not None:
+                task.cancel()
+
+    def login_expired(self) -> bool:
+        return self._last_login is None or time.monotonic() - self._last_login > self.LOGIN['ttl']
+
+    async def login(self):
+        if self._login_task is None:
+            self._login_task = asyncio.ensure_future(self._login())
+            self._login_task.add_done_callback(lambda _: setattr(self, '_login_task', None))
+        await asyncio.shield(self._login_task)
+
+    async def _login(self):
+        try:
+            if self._shared_state is None:
+                await self._login_session()
+            else:
+                # One process logs in at a time, the others load its session unless it is not newer than theirs.
+                async with self._shared_state.lock(f'{self._shared_key}:login_lock', self.LOGIN['lock_ttl']):
+                    if not await self._load_shared_login():
+                        await self._login_session()
+                        cookies = [(c.key, c.value, c['domain'], c['path']) for c in self._session.cookie_jar]
+                        await self._shared_state.set(f'{self._shared_key}:login', orjson.dumps(dict(time=self._login_time, user=self._user, cookies=cookies)), self.LOGIN['ttl'])
+        except Exception:
+            self._last_login = None
+            raise
+
+        self._last_login = time.monotonic() - (time.time() - self._login_time)
+        if self._refresh_login_task is None:
+            self._refresh_login_task = asyncio.create_task(self._refresh_login())
+
+    async def _login_session(self):
+        await login_deezer_session(self._session, self._email, self._password_md5, self._settings.client_id, self._settings.client_secret)
+        self._user = await call_deezer_gateway(self._session, 'deezer.getUserData', {}, None)
+        self._login_time = time.time()
+
+    async def _load_shared_login(self) -> bool:
+        if (data := await self._shared_state.get(f'{self._shared_key}:login')) is None:
+            return False
+        login = orjson.loads(data)
+        if time.time() - login['time'] > self.LOGIN['refresh'] or (self._login_time is not None and login['time'] <= self._login_time):
+            return False
+
+        cookies = SimpleCookie()
+        for name, value, domain, path in login['cookies']:
+            cookies[name] = value
+            cookies[name]['domain'] = domain
+            cookies[name]['path'] = path
+        self._session.cookie_jar.update_cookies(cookies)
+        self._user = login['user']
+        self._login_time = login['time']
+        return True
+
+    async def _refresh_login(self):
+        while True:
+            if self._last_login is None:
+                await asyncio.sleep(self.LOGIN['retry'])
+            else:
+                await asyncio.sleep(self._last_login + self.LOGIN['refresh'] - time.monotonic())
+            try:
+                await self.login()
+            except Exception:
+                pass
 
     async def _call_gateway(self, method: str, data: dict) -> dict:
         async with self._gateway_rate_limiter:
-            logged_in = False
-            while not logged_in:
-                if self._last_login is None or (datetime.datetime.now() - self._last_login) > datetime.timedelta(minutes=30):
-                    self._last_login = None
-
-                    await login_deezer_session(self._session, self._settings.email, self._password_md5, self._settings.client_id, self._settings.client_secret)
-                    self._user = await call_deezer_gateway(self._session, 'deezer.getUserData', {}, None)
+            logged_in = self.login_expired()
+            if logged_in:
+                await self.login()
 
-                    self._last_login = datetime.datetime.now()
-                    logged_in = True
+            try:
+                return await call_deezer_gateway(self._session, method, data, self._user['checkForm'])
+            except Exception:
+                if logged_in:
+                    raise
 
-                try:
-                    return await call_deezer_gateway(self._session, method, data, self._user['checkForm'])
-                except Exception:
-                    self._last_login = None
-                    if logged_in:
-                        raise
-                    continue
+            await self.login()
+            return await call_deezer_gateway(self._session, method, data, self._user['checkForm'])
 
     async def get_gateway_track_page(self, id_: str) -> dict:
+        return await self._track_pages_cache.get(id_, lambda: self._get_gateway_track_page(id_))
+
+    async def _get_gateway_track_page(self, id_: str) -> dict:
         page = await self._call_gateway('deezer.pageTrack', {'SNG_ID': id_})
         if (fallback := page['DATA'].get('FALLBACK')):
             page = await self._call_gateway('deezer.pageTrack', {'SNG_ID': fallback['SNG_ID']})
         return page
 
     async def get_gateway_album_page(self, id_: str) -> dict:
-        return await self._call_gateway('deezer.pageAlbum', {'ALB_ID': id_, 'lang': 'en', 'header': True, 'tab': 0})
+        return await self._album_pages_cache.get(id_, lambda: self._call_gateway('deezer.pageAlbum', {'ALB_ID': id_, 'lang': 'en', 'header': True, 'tab': 0}))
+
+    async def get_gateway_playlist_page(self, id_: str, index: int = 0, limit: int = -1) -> dict:
+        return await self._playlist_pages_cache.get((id_, index, limit), lambda: self._call_gateway('deezer.pagePlaylist', {'PLAYLIST_ID': id_, 'lang': 'en', 'start': index, 'nb': limit, 'tags': True}))
 
-    async def get_gateway_playlist_page(self, id_: str) -> dict:
-        return await self._call_gateway('deezer.pagePlaylist', {'PLAYLIST_ID': id_, 'lang': 'en', 'start': 0, 'nb': -1, 'tags': True})
+    async def get_gateway_playlist_pages(self, id_: str) -> AsyncIterator[dict]:
+        # Yields the playlist pages in order, the first one has the playlist data and the track count,
+        # at most PLAYLIST_PAGES_CONCURRENCY of the following ones are fetched ahead.
+        page = await self.get_gateway_playlist_page(id_, 0, self.PLAYLIST_PAGE_SIZE)
+        yield page
+
+        total = int(page['SONGS'].get('total') or page['DATA'].get('NB_SONG') or 0)
+        indices = iter(range(self.PLAYLIST_PAGE_SIZE, total, self.PLAYLIST_PAGE_SIZE))
+        pending = deque()
+        try:
+            while True:
+                while len(pending) < self.PLAYLIST_PAGES_CONCURRENCY and (index := next(indices, None)) is not None:
+                    pending.append(asyncio.ensure_future(self.get_gateway_playlist_page(id_, index, self.PLAYLIST_PAGE_SIZE)))
+                if not pending:
+                    break
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def get_gateway_tracks(self, ids: list[str]) -> dict[str, dict]:
+        tracks = {t['SNG_ID']: t for t in (await self._call_gateway('song.getListData', {'SNG_IDS': ids}))['data']}
+        fallbacks = {id_: fallback['SNG_ID'] for id_, t in tracks.items() if (fallback := t.get('FALLBACK'))}
+        if fallbacks:
+            fallback_tracks = {t['SNG_ID']: t for t in (await self._call_gateway('song.getListData', {'SNG_IDS': [*fallbacks.values()]}))['data']}
+            tracks.update((id_, fallback_tracks[fallback_id]) for id_, fallback_id in fallbacks.items() if fallback_id in fallback_tracks)
+        return tracks
 
     async def get_gateway_search_results(self, query: str, type_: str, index: int, limit: int) -> dict:
-        return await self._call_gateway('search.music', {'query': query, 'output': type_, 'start': index, 'nb': limit, 'filter': 'ALL'})
+        query = ' '.join(query.lower().split())
+        results = await self._get_gateway_search_results(query, type_, index, limit)
+
+        # The next page is fetched ahead at bulk priority, only when the gateway rate limiter has room to spare.
+        if (next_ := results.get('next')) and next_ < results.get('total', 0) and (query, type_, next_, limit) not in self._search_results_cache and self._gateway_rate_limiter.idle(self.SEARCH_PREFETCH_CAPACITY):
+            task = asyncio.create_task(self._prefetch_gateway_search_results(query, type_, next_, limit))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        return results
+
+    async def _get_gateway_search_results(self, query: str, type_: str, index: int, limit: int) -> dict:
+        return await self._search_results_cache.get((query, type_, index, limit), lambda: self._call_gateway('search.music', {'query': query, 'output': type_, 'start': index, 'nb': limit, 'filter': 'ALL'}))
+
+    async def _prefetch_gateway_search_results(self, query: str, type_: str, index: int, limit: int):
+        upstream_priority.set('bulk')
+        self._search_prefetches += 1
+        try:
+            await self._get_gateway_search_results(query, type_, index, limit)
+        except Exception:
+            pass
 
     async def get_api_track(self, id_: str) -> dict:
+        return await self._api_tracks_cache.get(id_, lambda: self._get_api_track(id_))
+
+    async def _get_api_track(self, id_: str) -> dict:
         async with self._api_rate_limiter:
             return await call_deezer_api(self._session, f'track/{id_}')
 
+    async def wait_idle(self, limiter: Literal['gateway', 'api', 'tracks', 'images']):
+        # For requests that can be made later or not at all, such as prefetches.
+        limiters = dict(gateway=self._gateway_rate_limiter, api=self._api_rate_limiter, tracks=self._tracks_rate_limiter, images=self._images_rate_limiter)
+        await limiters[limiter].wait_idle(self.PREFETCH_CAPACITY)
+
+    async def prefetch_gateway_track_page(self, id_: str):
+        if id_ not in self._track_pages_cache:
+            await self.wait_idle('gateway')
+            await self.get_gateway_track_page(id_)
+
+    async def prefetch_gateway_album_page(self, id_: str):
+        if id_ not in self._album_pages_cache:
+            await self.wait_idle('gateway')
+            await self.get_gateway_album_page(id_)
+
+    async def prefetch_api_track(self, id_: str):
+        if id_ not in self._api_tracks_cache:
+            await self.wait_idle('api')
+            await self.get_api_track(id_)
+
+    def rate_limiter_stats(self) -> dict:
+        return dict(
+            gateway=self._gateway_rate_limiter.stats(),
+            api=self._api_rate_limiter.stats(),
+            tracks=self._tracks_rate_limiter.stats(),
+            images=self._images_rate_limiter.stats())
+
+    def cache_stats(self) -> dict:
+        return dict(
+            track_pages=self._track_pages_cache.stats(),
+            album_pages=self._album_pages_cache.stats(),
+            playlist_pages=self._playlist_pages_cache.stats(),
+            api_tracks=self._api_tracks_cache.stats(),
+            search_results=dict(self._search_results_cache.stats(), prefetches=self._search_prefetches))
+
+    def load(self) -> int:
+        return sum(s['queued'] for l in self.rate_limiter_stats().values() for s in l.values())
+
+    async def get_track_file_url(self, track_token: str, formats: list[str]) -> tuple[str, str]:
+        key = (track_token, tuple(formats))
+
+        if (entry := self._track_file_urls.get(key)) is not None:
+            expires, format_, url = entry
+            if expires - self.TRACK_FILE_URLS_CACHE['expiry_margin'] > time.time():
+                self._track_file_urls.move_to_end(key)
+                return format_, url
+            del self._track_file_urls[key]
+
+        if (future := self._track_file_urls_pending.get(key)) is None:
+            future = self._track_file_urls_pending[key] = asyncio.get_running_loop().create_future()
+            if (batch := self._track_file_urls_batches.get(key[1])) is None:
+                batch = self._track_file_urls_batches[key[1]] = []
+                task = asyncio.create_task(self._resolve_track_file_urls(key[1]))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            batch.append(track_token)
+
+        return await asyncio.shield(future)
+
+    async def _resolve_track_file_urls(self, formats: tuple[str]):
+        await asyncio.sleep(self.TRACK_FILE_URLS_BATCH['delay'])
+        batch = self._track_file_urls_batches.pop(formats)
+        await gather_cancel(*(
+            self._resolve_track_file_urls_batch(batch[i:i + self.TRACK_FILE_URLS_BATCH['max_size']], formats)
+            for i in range(0, len(batch), self.TRACK_FILE_URLS_BATCH['max_size'])))
+
+    async def _resolve_track_file_urls_batch(self, track_tokens: list[str], formats: tuple[str]):
+        futures = [self._track_file_urls_pending.pop((t, formats)) for t in track_tokens]
+        try:
+            if self.login_expired():
+                await self.login()
+            async with self._tracks_rate_limiter:
+                results = await get_deezer_track_file_urls(self._session, track_tokens, [*formats], self._user['USER']['OPTIONS']['license_token'])
+            if len(results) != len(track_tokens):
+                raise Exception(results)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        for track_token, future, result in zip(track_tokens, futures, results):
+            if 'errors' in result or not result.get('media'):
+                future.set_exception(Exception(result))
+                continue
+
+            media = result['media'][0]
+            self._track_file_urls[(track_token, formats)] = (media.get('exp', 0), media['format'], media['sources'][0]['url'])
+            while len(self._track_file_urls) > self.TRACK_FILE_URLS_CACHE['max_size']:
+                self._track_file_urls.popitem(last=False)
+            future.set_result((media['format'], media['sources'][0]['url']))
+
+    @asynccontextmanager
+    async def open_track(self, id_: str, track_token: str, formats: list[str], start: int = 0, end: int | None = None) -> AsyncIterator[tuple[str, AsyncBytesReader]]:
+        format_, url = await self.get_track_file_url(track_token, formats)
+
+        # Upstream ranges are widened to whole blocks, which the decryptor can start from at any index.
+        open_ = self._open_track_segments if self._settings.track_segment_connections > 1 else self._open_track_stream
+        async with open_(id_, url, start - start % DEEZER_TRACK_FILE_BLOCK_SIZE, None if end is None else -(-end // DEEZER_TRACK_FILE_BLOCK_SIZE) * DEEZER_TRACK_FILE_BLOCK_SIZE) as (offset, chunks, available):
+            size = None if available is None else max(min(available, end or available) - start, 0)
+            async with aclosing(slice_chunks(chunks, start - offset, size)) as chunks:
+                yield format_, AsyncBytesReader(chunks, size)
+
+    @asynccontextmanager
+    async def _open_track_stream(self, id_: str, url: str, start: int, end: int | None) -> AsyncIterator[tuple[int, AsyncIterator[bytes], int | None]]:
+        headers = {}
+        if start or end is not None:
+            headers['Range'] = f'bytes={start}-' + ('' if end is None else str(end - 1))
+
+        async with self._session.get(url, headers=headers) as response:
+            response.raise_for_status()
+            if response.status != 206:
+                start = 0
+
+            async with aclosing(decrypt_deezer_track_file_http_stream(id_, response.content, self._track_decryption_secret, start // DEEZER_TRACK_FILE_BLOCK_SIZE, run=self._decrypt)) as chunks:
+                yield start, chunks, None if response.content_length is None else start + response.content_length
+
+    @asynccontextmanager
+    async def _open_track_segments(self, id_: str, url: str, start: int, end: int | None) -> AsyncIterator[tuple[int, AsyncIterator[bytes], int | None]]:
+        segments = read_deezer_track_file_segments(
+            self._session, url, id_, self._track_decryption_secret, start, end,
+            self._settings.track_segment_size, self._settings.track_segment_connections,
+            **self.TRACK_SEGMENTS_RETRY, run=self._decrypt)
+
+        async with aclosing(segments):
+            first, total = await anext(segments)
+
+            async def read():
+                yield first
+                async for data, _ in segments:
+                    yield data
+
+            async with aclosing(read()) as chunks:
+                yield start, chunks, total if end is None else min(end, total)
+
+    async def _decrypt(self, f: Callable, data: bytearray, index: int) -> bytearray:
+        track_file_downloaded_bytes.inc(len(data))
+        start = time.perf_counter()
+        data = f(data, index) if self._workers is None else await self._workers.run(f, data, index)
+        track_file_decrypt_seconds.inc(time.perf_counter() - start)
+        track_file_decrypted_bytes.inc(len(data))
+        return data
+
     async def download_track(self, id_: str, track_token: str, format_: str) -> bytes:
-        async with self._tracks_rate_limiter:
-            url = await get_deezer_track_file_url(self._session, track_token, format_, self._user['USER']['OPTIONS']['license_token'])
+        async with self.open_track(id_, track_token, [format_]) as (_, track):
+            return await track.read()
 
-            data = bytearray()
+    async def download_image(self, url: str) -> bytes:
+        async with self._images_rate_limiter:
             async with self._session.get(url) as response:
                 response.raise_for_status()
-                async for chunk in decrypt_deezer_track_file_http_stream(id_, response.content, self._track_decryption_secret):
-                    data += chunk
-            return bytes(data)
+                return await response.read()
 
-    async def download_image(self, url: str) -> bytes:
-        async with self._images_rate_limiter:
-            i = 0
-            while True:
-                try:
-                    async with self._session.get(url) as response:
-                        response.raise_for_status()
-                        return await response.read()
-                except Exception:
-                    if (i := i + 1) == self.IMAGES_COOLDOWN['attempts']:
-                        raise
-                    await asyncio.sleep(IMAGES_COOLDOWN['cooldown'])
+
+current_deezer_client = contextvars.ContextVar('current_deezer_client', default=None)
+
+
+class DeezerClientPool:
+    def __init__(self, clients: list[DeezerClient]):
+        self._clients = clients
+        self._next = 0
+
+    def __getattr__(self, name: str):
+        return getattr(current_deezer_client.get() or self.select(), name)
+
+    @property
+    def clients(self) -> list[DeezerClient]:
+        return self._clients
+
+    def select(self) -> DeezerClient:
+        clients = self._clients[self._next:] + self._clients[:self._next]
+        self._next = (self._next + 1) % len(self._clients)
+        return min(clients, key=lambda c: c.load())
+
+    async def aclose(self):
+        for client in self._clients:
+            await client.aclose()
 
 
 def parse_track(gateway_track: dict, api_track: dict | None) -> dict:
@@ -124,7 +483,7 @@ def parse_track(gateway_track: dict, api_track: dict | None) -> dict:
     d['track_number'] = int(gateway_track['TRACK_NUMBER'])
 
     if (date := gateway_track.get('ORIGINAL_RELEASE_DATE') or gateway_track.get('PHYSICAL_RELEASE_DATE') or gateway_track.get('DIGITAL_RELEASE_DATE')) and date != '0000-00-00':
-        d['date'] = datetime.datetime.strptime(date, '%Y-%m-%d')
+        d['date'] = datetime.datetime.fromisoformat(date)
 
     d['duration_seconds'] = int(gateway_track['DURATION'])
 
@@ -188,7 +547,7 @@ def parse_album(gateway_album: dict, gateway_album_tracks: dict | None) -> dict:
         d['track_count'] = int(track_count)
 
     if (date := gateway_album.get('ORIGINAL_RELEASE_DATE') or gateway_album.get('PHYSICAL_RELEASE_DATE') or gateway_album.get('DIGITAL_RELEASE_DATE')) and date != '0000-00-00':
-        d['date'] = datetime.datetime.strptime(date, '%Y-%m-%d')
+        d['date'] = datetime.datetime.fromisoformat(date)
 
     if (contributors := gateway_album.get('ALB_CONTRIBUTORS')):
         if (composers := contributors.get('composer')):
@@ -232,7 +591,7 @@ def parse_playlist(gateway_playlist: dict) -> dict:
         d['duration_seconds'] = int(duration)
 
     if (date := gateway_playlist.get('DATE_MOD')):
-        d['date'] = datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
+        d['date'] = datetime.datetime.fromisoformat(date)
 
     d['deezer'] = {
         'id': gateway_playlist['PLAYLIST_ID'],
@@ -292,102 +651,173 @@ def create_track_tags(track: dict) -> dict:
     return tags
 
 
-def add_tags(f: mutagen.FileType, tags: dict):
+def create_flac_comments(tags: dict) -> list[tuple[str, str]]:
     tags = tags.copy()
-
-    match f:
-        case flac.FLAC():
-            if (v := tags.pop('title', None)) is not None:
-                f['TITLE'] = v
-            if (v := tags.pop('artists', None)) is not None:
-                f['ARTIST'] = v
-            if (v := tags.pop('album_title', None)) is not None:
-                f['ALBUM'] = v
-            if (v := tags.pop('album_artists', None)) is not None:
-                f['ALBUMARTIST'] = f['ALBUM ARTIST'] = v
-            if (v := tags.pop('album_disk_count', None)) is not None:
-                f['DISCTOTAL'] = str(v)
-            if (v := tags.pop('album_track_count', None)) is not None:
-                f['TRACKTOTAL'] = str(v)
-            if (v := tags.pop('disk_number', None)) is not None:
-                f['DISCNUMBER'] = str(v)
-            if (v := tags.pop('track_number', None)) is not None:
-                f['TRACKNUMBER'] = str(v)
-            if (v := tags.pop('album_date', None)) is not None:
-                f['DATE'] = v.strftime('%Y-%m-%d')
-            if (v := tags.pop('composers', None)) is not None:
-                f['COMPOSER'] = v
-            if (v := tags.pop('copyright', None)) is not None:
-                f['COPYRIGHT'] = v
-            if (v := tags.pop('album_publisher', None)) is not None:
-                f['PUBLISHER'] = v
-            if (v := tags.pop('isrc', None)) is not None:
-                f['ISRC'] = v
-            if (v := tags.pop('album_ean', None)) is not None:
-                f['EAN'] = v
-            if (v := tags.pop('explicit', None)) is not None:
-                f['ITUNESADVISORY'] = str(int(v))
-            if (v := tags.pop('bpm', None)) is not None:
-                f['BPM'] = format(v, '.2f').rstrip('0').rstrip('.')
-            for k, v in tags.items():
-                f[k.upper()] = v
-        case mp3.MP3():
-            if (v := tags.pop('title', None)) is not None:
-                f.tags.add(id3.TIT2(encoding=id3.Encoding.UTF8, text=v))
-            if (v := tags.pop('artists', None)) is not None:
-                f.tags.add(id3.TPE1(encoding=id3.Encoding.UTF8, text=v))
-            if (v := tags.pop('album_title', None)) is not None:
-                f.tags.add(id3.TALB(encoding=id3.Encoding.UTF8, text=v))
-            if (v := tags.pop('album_artists', None)) is not None:
-                f.tags.add(id3.TPE2(encoding=id3.Encoding.UTF8, text=v))
-            if (v := tags.pop('disk_number', None)) is not None:
-                f.tags.add(id3.TPOS(encoding=id3.Encoding.UTF8, text=str(v) + (f'/{total}' if (total := tags.pop('album_disk_count', None)) is not None else '')))
-            if (v := tags.pop('track_number', None)) is not None:
-                f.tags.add(id3.TRCK(encoding=id3.Encoding.UTF8, text=str(v) + (f'/{total}' if (total := tags.pop('album_track_count', None)) is not None else '')))
-            if (v := tags.pop('album_date', None)) is not None:
-                f.tags.add(id3.TDRC(encoding=id3.Encoding.UTF8, text=v.strftime('%Y-%m-%d')))
-            if (v := tags.pop('composers', None)) is not None:
-                f.tags.add(id3.TCOM(encoding=id3.Encoding.UTF8, text=v))
-            if (v := tags.pop('copyright', None)) is not None:
-                f.tags.add(id3.TCOP(encoding=id3.Encoding.UTF8, text=v))
-            if (v := tags.pop('album_publisher', None)) is not None:
-                f.tags.add(id3.TPUB(encoding=id3.Encoding.UTF8, text=v))
-            if (v := tags.pop('isrc', None)) is not None:
-                f.tags.add(id3.TSRC(encoding=id3.Encoding.UTF8, text=v))
-            if (v := tags.pop('album_ean', None)) is not None:
-                f.tags.add(id3.TXXX(encoding=id3.Encoding.UTF8, desc='EAN', text=v))
-            if (v := tags.pop('explicit', None)) is not None:
-                f.tags.add(id3.TXXX(encoding=id3.Encoding.UTF8, desc='ITUNESADVISORY', text=str(int(v))))
-            if (v := tags.pop('bpm', None)) is not None:
-                f.tags.add(id3.TBPM(encoding=id3.Encoding.UTF8, text=format(v, '.2f').rstrip('0').rstrip('.')))
-            for k, v in tags.items():
-                f.tags.add(id3.TXXX(encoding=id3.Encoding.UTF8, desc=k.upper(), text=str(v)))
+    f = dict()
+
+    if (v := tags.pop('title', None)) is not None:
+        f['TITLE'] = v
+    if (v := tags.pop('artists', None)) is not None:
+        f['ARTIST'] = v
+    if (v := tags.pop('album_title', None)) is not None:
+        f['ALBUM'] = v
+    if (v := tags.pop('album_artists', None)) is not None:
+        f['ALBUMARTIST'] = f['ALBUM ARTIST'] = v
+    if (v := tags.pop('album_disk_count', None)) is not None:
+        f['DISCTOTAL'] = str(v)
+    if (v := tags.pop('album_track_count', None)) is not None:
+        f['TRACKTOTAL'] = str(v)
+    if (v := tags.pop('disk_number', None)) is not None:
+        f['DISCNUMBER'] = str(v)
+    if (v := tags.pop('track_number', None)) is not None:
+        f['TRACKNUMBER'] = str(v)
+    if (v := tags.pop('album_date', None)) is not None:
+        f['DATE'] = v.strftime('%Y-%m-%d')
+    if (v := tags.pop('composers', None)) is not None:
+        f['COMPOSER'] = v
+    if (v := tags.pop('copyright', None)) is not None:
+        f['COPYRIGHT'] = v
+    if (v := tags.pop('album_publisher', None)) is not None:
+        f['PUBLISHER'] = v
+    if (v := tags.pop('isrc', None)) is not None:
+        f['ISRC'] = v
+    if (v := tags.pop('album_ean', None)) is not None:
+        f['EAN'] = v
+    if (v := tags.pop('explicit', None)) is not None:
+        f['ITUNESADVISORY'] = str(int(v))
+    if (v := tags.pop('bpm', None)) is not None:
+        f['BPM'] = format(v, '.2f').rstrip('0').rstrip('.')
+    for k, v in tags.items():
+        f[k.upper()] = v
+
+    return [(k, v) for k, values in f.items() for v in ([values] if isinstance(values, str) else values)]
+
+def create_id3_frames(tags: dict) -> list[bytes]:
+    tags = tags.copy()
+    frames = []
+
+    if (v := tags.pop('title', None)) is not None:
+        frames.append(create_id3_text_frame('TIT2', v))
+    if (v := tags.pop('artists', None)) is not None:
+        frames.append(create_id3_text_frame('TPE1', v))
+    if (v := tags.pop('album_title', None)) is not None:
+        frames.append(create_id3_text_frame('TALB', v))
+    if (v := tags.pop('album_artists', None)) is not None:
+        frames.append(create_id3_text_frame('TPE2', v))
+    if (v := tags.pop('disk_number', None)) is not None:
+        frames.append(create_id3_text_frame('TPOS', str(v) + (f'/{total}' if (total := tags.pop('album_disk_count', None)) is not None else '')))
+    if (v := tags.pop('track_number', None)) is not None:
+        frames.append(create_id3_text_frame('TRCK', str(v) + (f'/{total}' if (total := tags.pop('album_track_count', None)) is not None else '')))
+    if (v := tags.pop('album_date', None)) is not None:
+        frames.append(create_id3_text_frame('TDRC', v.strftime('%Y-%m-%d')))
+    if (v := tags.pop('composers', None)) is not None:
+        frames.append(create_id3_text_frame('TCOM', v))
+    if (v := tags.pop('copyright', None)) is not None:
+        frames.append(create_id3_text_frame('TCOP', v))
+    if (v := tags.pop('album_publisher', None)) is not None:
+        frames.append(create_id3_text_frame('TPUB', v))
+    if (v := tags.pop('isrc', None)) is not None:
+        frames.append(create_id3_text_frame('TSRC', v))
+    if (v := tags.pop('album_ean', None)) is not None:
+        frames.append(create_id3_txxx_frame('EAN', v))
+    if (v := tags.pop('explicit', None)) is not None:
+        frames.append(create_id3_txxx_frame('ITUNESADVISORY', str(int(v))))
+    if (v := tags.pop('bpm', None)) is not None:
+        frames.append(create_id3_text_frame('TBPM', format(v, '.2f').rstrip('0').rstrip('.')))
+    for k, v in tags.items():
+        frames.append(create_id3_txxx_frame(k.upper(), str(v)))
+
+    return frames
+
+def process_cover(data: bytes, format_: str) -> tuple[bytes, Image.Image]:
+    # Covers come from resize_image, in RGB.
+    image = Image.open(BytesIO(data))
+    image.format = format_.replace('jpg', 'jpeg').upper()
+    return data, image
+
+
+async def read_track_file_header(f: AsyncBytesReader, format_: str) -> bytes:
+    match format_.partition('_')[0]:
+        case 'FLAC':
+            header = await f.readexactly(4)
+            if header != b'fLaC':
+                raise Exception(header)
+            while True:
+                block_header = await f.readexactly(4)
+                header += block_header + await f.readexactly(int.from_bytes(block_header[1:], 'big'))
+                if block_header[0] & 0x80:
+                    return header
+        case 'MP3':
+            header = await f.read(10)
+            if (size := get_id3_size(header)):
+                header += await f.readexactly(size - len(header))
+            return header
         case _:
             raise NotImplementedError()
 
-def add_tags_picture(f: mutagen.FileType, data: bytes, image: Image.Image, type_: id3.PictureType, description: str):
-    match f:
-        case flac.FLAC():
-            picture = flac.Picture()
-            picture.type = type_
-            picture.mime = Image.MIME[image.format]
-            picture.desc = description
-            picture.width = image.size[0]
-            picture.height = image.size[1]
-            picture.depth = {'RGB': 24, 'RGBA': 32}[image.mode]
-            picture.colors = 0
-            picture.data = data
-            f.add_picture(picture)
-        case mp3.MP3():
-            f.tags.add(id3.APIC(
-                encoding=id3.Encoding.UTF8,
-                mime=Image.MIME[image.format],
-                type=type_,
-                desc=description,
-                data=data))
+def create_track_file_header(header: bytes, format_: str, tags: dict, cover_data: bytes, cover_image: Image.Image) -> bytes:
+    match format_.partition('_')[0]:
+        case 'FLAC':
+            picture = create_flac_picture(PICTURE_COVER_FRONT, Image.MIME[cover_image.format], '', *cover_image.size, {'RGB': 24}[cover_image.mode], cover_data)
+            return write_flac_header(header, create_flac_comments(tags), [picture])
+        case 'MP3':
+            return write_id3_header(header, [*create_id3_frames(tags), create_id3_apic_frame(Image.MIME[cover_image.format], PICTURE_COVER_FRONT, '', cover_data)])
         case _:
             raise NotImplementedError()
 
+def process_track_file_header(header: bytes, format_: str, tags: dict, cover_data: bytes, cover_format: str) -> tuple[bytes, float, float]:
+    # Runs in the worker pool, in a single job since PIL images lose their format when sent to a worker process.
+    start = time.perf_counter()
+    cover_data, cover_image = process_cover(cover_data, cover_format)
+    cover_seconds = time.perf_counter() - start
+    header = create_track_file_header(header, format_, tags, cover_data, cover_image)
+    return header, cover_seconds, time.perf_counter() - start - cover_seconds
+
+async def tag_track_file_header(header: bytes, format_: str, tags: dict, cover_data: bytes, cover_format: str) -> bytes:
+    start = time.perf_counter()
+    header, cover_seconds, tags_seconds = await workers.run(process_track_file_header, header, format_, tags, cover_data, cover_format)
+    track_file_processing_seconds.observe(time.perf_counter() - start - cover_seconds - tags_seconds, stage='queue')
+    track_file_processing_seconds.observe(cover_seconds, stage='cover')
+    track_file_processing_seconds.observe(tags_seconds, stage='tags')
+    return header
+
+async def stream_track_file(stack: AsyncExitStack, header: bytes, track: AsyncBytesReader | None) -> AsyncIterator[bytes]:
+    downloads_in_progress.inc(type='track')
+    try:
+        async with stack:
+            yield header
+            if track is not None:
+                async for chunk in track:
+                    yield bytes(chunk)
+    finally:
+        downloads_in_progress.dec(type='track')
+
+
+def get_upstream_call(url: URL) -> tuple[str, str]:
+    match url.host, url.path:
+        case 'www.deezer.com', '/ajax/gw-light.php':
+            return 'gateway', url.query.get('method', '')
+        case 'api.deezer.com', path:
+            return 'api' if path.startswith('/2.0/') else 'auth', ''
+        case 'media.deezer.com', '/v1/get_url':
+            return 'get_url', ''
+        case _, path if path.startswith('/images/'):
+            return 'image', ''
+        case _:
+            return 'track', ''
+
+async def measure_upstream_request(request: aiohttp.ClientRequest, handler) -> aiohttp.ClientResponse:
+    call, method = get_upstream_call(request.url)
+    start = time.perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        upstream_request_seconds.observe(time.perf_counter() - start, call=call, method=method)
+
+
+class Account(BaseModel):
+    email: str
+    password_md5: str
 
 class Settings(BaseSettings):
     track_decryption_secret: str
@@ -395,27 +825,194 @@ class Settings(BaseSettings):
     client_secret: str
     email: str
     password_md5: str
+    accounts: list[Account] = []
+    download_concurrency: int = 4
+    track_cache_path: str | None = None
+    track_cache_size: int = 1024 ** 3 * 10
+    track_segment_size: int = 1024 ** 2
+    track_segment_connections: int = 1
+    upstream_connections: int = 100
+    upstream_connections_per_host: int = 16
+    upstream_keepalive_timeout: float = 60
+    upstream_dns_cache_ttl: int = 60 * 5
+    upstream_url: str | None = None
+    worker_pool: Literal['thread', 'process'] = 'thread'
+    worker_pool_size: int = 4
+    worker_pool_queue_size: int = 32
+    event_loop_monitor_interval: float = 0.5
+    jobs_path: str = 'jobs'
+    jobs_concurrency: int = 2
+    jobs_ttl: float = 60 * 60 * 24 * 7
+    shared_state_url: str | None = None
+    prefetch: bool = False
+    memory_budget: int = 1024 ** 3
+    memory_budget_max_queued: int = 64
+    memory_budget_timeout: float = 10
+    image_cache_path: str = 'images'
+    image_cache_size: int = 1024 ** 3
 
     class Config:
         env_prefix = 'deezl_'
 
+async def set_upstream_client(request: Request):
+    upstream_client.set(request.headers.get('x-forwarded-for', request.client.host if request.client else '').split(',')[0].strip())
+
+async def set_deezer_client():
+    current_deezer_client.set(deezer.select())
+
 settings = Settings()
-app = FastAPI(title='deezl-api')
+app = FastAPI(title='deezl-api', default_response_class=ORJSONResponse, dependencies=[Depends(set_upstream_client), Depends(set_deezer_client)])
+app.add_middleware(CompressionMiddleware, **COMPRESSION)
 stack = AsyncExitStack()
 deezer = None
+track_cache = None
+workers = None
+event_loop_monitor = None
+track_file_headers = None
+images = None
+image_masters = None
+image_cache = None
+shared_state = None
+prefetcher = None
+track_file_broadcasts = {}
+memory_budget = None
+transport = None
+jobs = None
 
 @app.on_event('startup')
 async def startup():
-    session = create_deezer_client_session()
-    await stack.enter_async_context(session)
+    global workers
+    workers = WorkerPool(settings.worker_pool, settings.worker_pool_size, settings.worker_pool_queue_size)
+    stack.callback(workers.shutdown)
+
+    global event_loop_monitor
+    event_loop_monitor = EventLoopMonitor(settings.event_loop_monitor_interval)
+    event_loop_monitor.start()
+    stack.push_async_callback(event_loop_monitor.aclose)
+
+    global shared_state
+    if settings.shared_state_url is not None:
+        shared_state = create_shared_state(settings.shared_state_url)
+        stack.push_async_callback(shared_state.aclose)
+
+    global transport
+    transport = Transport(**UPSTREAM_TRANSPORT)
+    connector = create_connector(settings.upstream_connections, settings.upstream_connections_per_host, settings.upstream_keepalive_timeout, settings.upstream_dns_cache_ttl)
+    stack.push_async_callback(connector.close)
+
+    clients = []
+    for account in [Account(email=settings.email, password_md5=settings.password_md5), *settings.accounts]:
+        middlewares = [measure_upstream_request, transport]
+        if settings.upstream_url is not None:
+            middlewares.append(create_upstream_override(settings.upstream_url))
+        session = create_deezer_client_session(connector=connector, connector_owner=False, middlewares=middlewares, timeout=aiohttp.ClientTimeout(**UPSTREAM_TIMEOUT))
+        await stack.enter_async_context(session)
+        clients.append(DeezerClient(settings, account, session, workers, shared_state))
 
     global deezer
-    deezer = DeezerClient(settings, session)
+    deezer = DeezerClientPool(clients)
+    stack.push_async_callback(deezer.aclose)
+
+    global track_file_headers
+    track_file_headers = MemoryCache(**TRACK_FILE_HEADERS_CACHE)
+
+    global images, image_masters, image_cache
+    images = MemoryCache(**IMAGES_CACHE, shared_state=shared_state, namespace='images', dumps=bytes, loads=bytes)
+    image_masters = MemoryCache(**IMAGE_MASTERS_CACHE)
+    image_cache = FileCache(settings.image_cache_path, settings.image_cache_size)
+
+    if settings.track_cache_path is not None:
+        global track_cache
+        track_cache = FileCache(settings.track_cache_path, settings.track_cache_size)
+
+    if settings.prefetch:
+        global prefetcher
+        prefetcher = Prefetcher(PREFETCH['max_tasks'], PREFETCH['timeout'])
+        stack.push_async_callback(prefetcher.aclose)
+
+    global memory_budget
+    memory_budget = MemoryBudget(settings.memory_budget, settings.memory_budget_max_queued, settings.memory_budget_timeout)
+
+    global jobs
+    jobs = JobQueue(settings.jobs_path, run_job, settings.jobs_concurrency, settings.jobs_ttl)
+    jobs.start()
+    stack.push_async_callback(jobs.aclose)
 
 @app.on_event('shutdown')
 async def shutdown():
     await stack.aclose()
 
+@app.exception_handler(MemoryBudgetExceeded)
+async def memory_budget_exceeded(request: Request, e: MemoryBudgetExceeded):
+    return Response(status_code=503, headers={'Retry-After': str(math.ceil(e.retry_after))})
+
+@app.get('/stats')
+async def stats():
+    return dict(
+        accounts=[dict(caches=c.cache_stats(), rate_limiters=c.rate_limiter_stats()) for c in deezer.clients],
+        track_file_headers=track_file_headers.stats(),
+        images=images.stats(),
+        image_masters=image_masters.stats(),
+        transport=transport.stats(),
+        workers=workers.stats(),
+        event_loop=event_loop_monitor.stats(),
+        jobs=jobs.stats(),
+        memory_budget=memory_budget.stats(),
+        prefetches=None if prefetcher is None else prefetcher.stats())
+
+@app.get('/metrics')
+async def metrics():
+    return Response(metrics_registry.render(), media_type=MetricsRegistry.CONTENT_TYPE)
+
+@metrics_registry.collector
+def collect_metrics() -> list[Metric]:
+    rate_limiter_wait = Summary('deezl_rate_limiter_wait_seconds', 'Time spent waiting on upstream rate limiters', ['account', 'limiter', 'priority'])
+    rate_limiter_queued = Gauge('deezl_rate_limiter_queued', 'Requests waiting on upstream rate limiters', ['account', 'limiter', 'priority'])
+    cache_hits = Counter('deezl_cache_hits_total', 'Cache hits', ['account', 'cache'])
+    cache_misses = Counter('deezl_cache_misses_total', 'Cache misses', ['account', 'cache'])
+    cache_hit_ratio = Gauge('deezl_cache_hit_ratio', 'Cache hits over lookups', ['account', 'cache'])
+    cache_size = Gauge('deezl_cache_size', 'Cache entries', ['account', 'cache'])
+
+    caches = [('', 'track_file_headers', track_file_headers.stats())]
+    for i, client in enumerate(deezer.clients):
+        for limiter, priorities in client.rate_limiter_stats().items():
+            for priority, s in priorities.items():
+                rate_limiter_wait.set(s['acquired'], s['wait_seconds'], account=i, limiter=limiter, priority=priority)
+                rate_limiter_queued.set(s['queued'], account=i, limiter=limiter, priority=priority)
+        caches.extend((i, cache, s) for cache, s in client.cache_stats().items())
+    caches.append(('', 'images', images.stats()))
+    caches.append(('', 'image_masters', image_masters.stats()))
+
+    for account, cache, s in caches:
+        cache_hits.inc(s['hits'], account=account, cache=cache)
+        cache_misses.inc(s['misses'], account=account, cache=cache)
+        cache_hit_ratio.set(s['hits'] / (s['hits'] + s['misses']) if s['hits'] + s['misses'] else 0, account=account, cache=cache)
+        cache_size.set(s['size'], account=account, cache=cache)
+
+    worker_pool = Gauge('deezl_worker_pool_jobs', 'Worker pool jobs', ['state'])
+    for state in ('pending', 'waiting'):
+        worker_pool.set(workers.stats()[state], state=state)
+
+    event_loop_lag = Gauge('deezl_event_loop_lag_seconds', 'Event loop lag', ['stat'])
+    for stat, key in (('last', 'lag_seconds'), ('max', 'max_lag_seconds'), ('mean', 'mean_lag_seconds')):
+        event_loop_lag.set(event_loop_monitor.stats()[key], stat=stat)
+
+    upstream_retries = Counter('deezl_upstream_retries_total', 'Retried upstream requests')
+    upstream_retries.inc(transport.stats()['retries'])
+    upstream_circuit_open = Gauge('deezl_upstream_circuit_open', 'Whether requests to an upstream host currently fail fast', ['host'])
+    for host, s in transport.stats()['hosts'].items():
+        upstream_circuit_open.set(s['state'] == 'open', host=host)
+
+    memory_budget_bytes = Gauge('deezl_memory_budget_bytes', 'Bytes reserved by downloads in progress', ['state'])
+    memory_budget_bytes.set(memory_budget.stats()['used'], state='used')
+    memory_budget_bytes.set(memory_budget.stats()['max_bytes'], state='max')
+    memory_budget_queued = Gauge('deezl_memory_budget_queued', 'Downloads waiting for memory')
+    memory_budget_queued.set(memory_budget.stats()['queued'])
+    memory_budget_rejected = Counter('deezl_memory_budget_rejected_total', 'Downloads rejected for lack of memory')
+    memory_budget_rejected.inc(memory_budget.stats()['rejected'])
+
+    return [rate_limiter_wait, rate_limiter_queued, cache_hits, cache_misses, cache_hit_ratio, cache_size, worker_pool, event_loop_lag, upstream_retries, upstream_circuit_open, memory_budget_bytes, memory_budget_queued, memory_budget_rejected]
+
 @app.get('/track/{id}')
 async def track(id: str, full: bool = False):
     id_ = id
@@ -442,48 +1039,109 @@ async def track(id: str, full: bool = False):
             gateway_album_tracks=gateway_album_tracks,
             api_track=api_track)
 
-    return response
+    return ORJSONResponse(response)
+
+@app.post('/tracks')
+async def tracks(ids: list[str] = Body(..., max_items=TRACKS_MAX_IDS), full: bool = False, fields: str | None = None):
+    upstream_priority.set('bulk')
+    return StreamingResponse(stream_ndjson(get_tracks(list(dict.fromkeys(ids)), full, parse_fields(fields))), media_type='application/x-ndjson')
+
+async def get_tracks(ids: list[str], full: bool, fields: dict | None) -> AsyncIterator[dict]:
+    results = asyncio.Queue()
+
+    async def get_batch(ids):
+        try:
+            gateway_tracks = await deezer.get_gateway_tracks(ids)
+        except Exception:
+            gateway_tracks = {}
+        await asyncio.gather(*(get_track(id_, gateway_tracks.get(id_)) for id_ in ids))
+
+    async def get_track(id_, gateway_track):
+        try:
+            if gateway_track is None:
+                raise Exception(id_)
+
+            gateway_album_page = await deezer.get_gateway_album_page(gateway_track['ALB_ID'])
+            gateway_album = gateway_album_page['DATA']
+            gateway_album_tracks = gateway_album_page['SONGS']['data']
+
+            result = dict(
+                id=id_,
+                track=select_fields(parse_track(gateway_track, None), fields),
+                album=parse_album(gateway_album, gateway_album_tracks))
+
+            if full:
+                result.update(
+                    gateway_track=gateway_track,
+                    gateway_album=gateway_album,
+                    gateway_album_tracks=gateway_album_tracks)
+        except Exception:
+            result = dict(id=id_, error=True)
+        results.put_nowait(result)
+
+    tasks = [asyncio.create_task(get_batch(ids[i:i + TRACKS_BATCH_SIZE])) for i in range(0, len(ids), TRACKS_BATCH_SIZE)]
+    try:
+        for _ in ids:
+            yield await results.get()
+    finally:
+        for task in tasks:
+            task.cancel()
 
 @app.get('/album/{id}')
-async def album(id: str, full: bool = False):
+async def album(id: str, full: bool = False, fields: str | None = None, cover_format: ImageFormat | None = None, cover_size: str | None = Query(None, regex=IMAGE_SIZE_REGEX)):
     id_ = id
 
     gateway_album_page = await deezer.get_gateway_album_page(id_)
     gateway_album = gateway_album_page['DATA']
     gateway_album_tracks = gateway_album_page['SONGS']['data']
+    start_prefetch(gateway_album_tracks, cover_format, cover_size)
 
     response = dict(
         album=parse_album(gateway_album, gateway_album_tracks),
-        tracks=[parse_track(t, None) for t in gateway_album_tracks])
+        tracks=select_fields([parse_track(t, None) for t in gateway_album_tracks], parse_fields(fields)))
 
     if full:
         response.update(
             gateway_album=gateway_album,
             gateway_album_tracks=gateway_album_tracks)
 
-    return response
+    return ORJSONResponse(response)
 
 @app.get('/playlist/{id}')
-async def playlist(id: str, full: bool = False):
+async def playlist(id: str, full: bool = False, fields: str | None = None, cover_format: ImageFormat | None = None, cover_size: str | None = Query(None, regex=IMAGE_SIZE_REGEX)):
     id_ = id
 
-    gateway_playlist_page = await deezer.get_gateway_playlist_page(id_)
-    gateway_playlist = gateway_playlist_page['DATA']
-    gateway_playlist_tracks = gateway_playlist_page['SONGS']['data']
-
-    response = dict(
-        playlist=parse_playlist(gateway_playlist),
-        tracks=[parse_track(t, None) for t in gateway_playlist_tracks])
-
-    if full:
-        response.update(
-            gateway_playlist=gateway_playlist,
-            gateway_playlist_tracks=gateway_playlist_tracks)
-
-    return response
+    gateway_playlist_pages = deezer.get_gateway_playlist_pages(id_)
+    try:
+        gateway_playlist_page = await anext(gateway_playlist_pages)
+    except BaseException:
+        await gateway_playlist_pages.aclose()
+        raise
+    start_prefetch(gateway_playlist_page['SONGS']['data'], cover_format, cover_size)
+
+    return StreamingResponse(stream_ndjson_batches(get_playlist(gateway_playlist_page, gateway_playlist_pages, full, parse_fields(fields))), media_type='application/x-ndjson')
+
+async def get_playlist(gateway_playlist_page: dict, gateway_playlist_pages: AsyncIterator[dict], full: bool, fields: dict | None) -> AsyncIterator[list[dict]]:
+    async with aclosing(gateway_playlist_pages):
+        gateway_playlist = gateway_playlist_page['DATA']
+
+        result = dict(playlist=parse_playlist(gateway_playlist))
+        if full:
+            result.update(gateway_playlist=gateway_playlist)
+        yield [result]
+
+        while gateway_playlist_page is not None:
+            results = []
+            for gateway_track in gateway_playlist_page['SONGS']['data']:
+                result = dict(track=select_fields(parse_track(gateway_track, None), fields))
+                if full:
+                    result.update(gateway_track=gateway_track)
+                results.append(result)
+            yield results
+            gateway_playlist_page = await anext(gateway_playlist_pages, None)
 
 @app.get('/search')
-async def search(query: str, type: str, index: int, limit: int, full: bool = False):
+async def search(query: str, type: str, index: int, limit: int, full: bool = False, fields: str | None = None):
     type_ = type
 
     gateway_results = await deezer.get_gateway_search_results(query, type_.upper(), index, limit)
@@ -502,65 +1160,491 @@ async def search(query: str, type: str, index: int, limit: int, full: bool = Fal
         results=dict(
             total=gateway_results['total'],
             next=gateway_results.get('next', 0),
-            data=data))
+            data=select_fields(data, parse_fields(fields))))
 
     if full:
         response.update(
             gateway_results=gateway_results)
 
-    return response
+    return ORJSONResponse(response)
 
-@alru_cache(maxsize=32)
-async def download_gateway_track_album_cover(md5: bytes, size: tuple[int, int], format_: str) -> bytes:
-    url = create_deezer_image_url('cover', md5, size, None, 100, False, format_)
-    return await deezer.download_image(url)
-
-@app.get('/track/{id}/download')
-async def download(id: str, format: str, cover_format: str, cover_size: str):
-    id_ = id
+@app.get('/image/{type}/{md5}')
+async def image(type: Literal['cover', 'artist', 'playlist', 'user', 'misc'], md5: str = Path(regex='^[0-9a-f]{32}$'), size: str = Query(regex=IMAGE_SIZE_REGEX), format: ImageFormat = 'jpg'):
+    type_ = type
     format_ = format
+    size = tuple(map(int, size.split('x', 1)))
+
+    if not all(0 < s <= m for s, m in zip(size, IMAGE_MASTER['size'])):
+        return Response(status_code=400)
+
+    data = await get_image(type_, bytes.fromhex(md5), size, format_)
+    return Response(data, media_type=f'image/{format_.replace("jpg", "jpeg")}', headers={'Cache-Control': 'public, max-age=31536000, immutable'})
+
+async def stream_ndjson(items: AsyncIterator) -> AsyncIterator[bytes]:
+    async for item in items:
+        yield orjson.dumps(item) + b'\n'
+
+async def stream_ndjson_batches(batches: AsyncIterator[list]) -> AsyncIterator[bytes]:
+    async for batch in batches:
+        yield b''.join(orjson.dumps(item) + b'\n' for item in batch)
+
+async def stream_sse(events: AsyncIterator[dict | None]) -> AsyncIterator[bytes]:
+    async for event in events:
+        yield b': keepalive\n\n' if event is None else b'data: ' + orjson.dumps(event) + b'\n\n'
+
+def create_image_key(type_: str, md5: bytes, size: tuple[int, int] | None = None, format_: str | None = None) -> str:
+    # Master images are keyed by type and md5 only.
+    return f'{type_}/{md5.hex()}' if size is None else f'{type_}/{md5.hex()}/{size[0]}x{size[1]}.{format_}'
+
+def read_image_cache(key: str) -> bytes | None:
+    if (data := image_cache.open(key)) is None:
+        return None
+    with data:
+        return data[:]
+
+def write_image_cache(key: str, data: bytes):
+    writer = image_cache.create(key)
+    try:
+        writer.write(data)
+        writer.commit()
+    finally:
+        writer.abort()
+
+async def get_image(type_: str, md5: bytes, size: tuple[int, int], format_: str) -> bytes:
+    # Images of any size and format are made from a master image, downloaded once per md5. Both are cached in memory
+    # and on disk.
+    key = create_image_key(type_, md5, size, format_)
+    return await images.get(key, lambda: create_image(key, type_, md5, size, format_))
+
+async def create_image(key: str, type_: str, md5: bytes, size: tuple[int, int], format_: str) -> bytes:
+    if (data := read_image_cache(key)) is not None:
+        image_derivatives.inc(source='disk')
+        return data
+
+    data = await workers.run(resize_image, await get_image_master(type_, md5), size, format_)
+    write_image_cache(key, data)
+    image_derivatives.inc(source='master')
+    return data
+
+async def get_image_master(type_: str, md5: bytes) -> bytes:
+    key = create_image_key(type_, md5)
+    return await image_masters.get(key, lambda: download_image_master(key, type_, md5))
+
+async def download_image_master(key: str, type_: str, md5: bytes) -> bytes:
+    if (data := read_image_cache(key)) is None:
+        data = await deezer.download_image(create_deezer_image_url(type_, md5, IMAGE_MASTER['size'], None, 100, False, IMAGE_MASTER['format']))
+        write_image_cache(key, data)
+    return data
+
+async def prefetch_image(type_: str, md5: bytes, size: tuple[int, int], format_: str):
+    if (key := create_image_key(type_, md5, size, format_)) not in images and key not in image_cache:
+        if (key := create_image_key(type_, md5)) not in image_masters and key not in image_cache:
+            await deezer.wait_idle('images')
+        await get_image(type_, md5, size, format_)
+
+def resize_image(data: bytes, size: tuple[int, int], format_: str) -> bytes:
+    # Always in RGB, as the track file tags expect (masters can be grayscale or CMYK).
+    image = Image.open(BytesIO(data))
+    pil_format = format_.replace('jpg', 'jpeg').upper()
+    if image.size == size and image.format == pil_format and image.mode == 'RGB':
+        return data
+    image = image.resize(size, Image.LANCZOS)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    output = BytesIO()
+    image.save(output, pil_format, quality=IMAGE_JPEG_QUALITY)
+    return output.getvalue()
+
+async def prefetch_downloads(gateway_tracks: list[dict], cover_format: str | None, cover_size: tuple[int, int] | None):
+    # Warms what downloading the tracks needs before their files: album pages and covers, public API tracks
+    # and track pages, one request at a time with the rate limit budget nobody is waiting for.
+    # It stops at the first error, which is likely to be repeated.
+    upstream_priority.set('bulk')
+    gateway_tracks = gateway_tracks[:PREFETCH['max_tracks']]
+
+    for id_ in dict.fromkeys(t['ALB_ID'] for t in gateway_tracks):
+        await deezer.prefetch_gateway_album_page(id_)
+    if cover_format is not None and cover_size is not None:
+        for md5 in [*dict.fromkeys(t['ALB_PICTURE'] for t in gateway_tracks if t['ALB_PICTURE'])][:PREFETCH['max_covers']]:
+            await prefetch_image('cover', bytes.fromhex(md5), cover_size, cover_format)
+    for gateway_track in gateway_tracks:
+        await deezer.prefetch_api_track(gateway_track['SNG_ID'])
+    for gateway_track in gateway_tracks:
+        await deezer.prefetch_gateway_track_page(gateway_track['SNG_ID'])
+
+def start_prefetch(gateway_tracks: list[dict], cover_format: str | None, cover_size: str | None):
+    # Viewing an album or playlist replaces the prefetch of what the same client viewed before.
+    if prefetcher is not None:
+        prefetcher.submit(upstream_client.get(), prefetch_downloads(gateway_tracks, cover_format, None if cover_size is None else tuple(map(int, cover_size.split('x', 1)))))
+
+def create_track_file_key(gateway_track: dict, format_: str) -> str:
+    return '-'.join([gateway_track['SNG_ID'], gateway_track['MD5_ORIGIN'], gateway_track['MEDIA_VERSION'], format_])
+
+def create_track_file_etag(gateway_track: dict, format_: str, tags: dict, cover_format: str, cover_size: tuple[int, int]) -> str:
+    inputs = json.dumps([TRACK_FILE_TAGS_VERSION, create_track_file_key(gateway_track, format_), tags, gateway_track['ALB_PICTURE'], cover_format, cover_size], sort_keys=True, default=str)
+    return f'"{hashlib.sha256(inputs.encode()).hexdigest()[:32]}"'
+
+@asynccontextmanager
+async def open_track_file(gateway_track: dict, formats: list[str], start: int = 0, end: int | None = None) -> AsyncIterator[tuple[str, AsyncBytesReader]]:
+    if track_cache is not None:
+        # Files are cached under the format they were downloaded in, which can be any of the formats to fall back to.
+        for format_ in formats:
+            if (data := track_cache.open(create_track_file_key(gateway_track, format_))) is not None:
+                async with aclosing(read_mmap(data, DEEZER_TRACK_FILE_BUFFER_SIZE, start, end)) as chunks:
+                    yield format_, AsyncBytesReader(chunks, max(min(len(data), end or len(data)) - start, 0))
+                return
+
+    if start or end is not None:
+        async with deezer.open_track(gateway_track['SNG_ID'], gateway_track['TRACK_TOKEN'], formats, start, end) as result:
+            yield result
+        return
+
+    # Whole files requested at the same time are downloaded and decrypted once for all of them.
+    key = (gateway_track['SNG_ID'], tuple(formats))
+    if (broadcast := track_file_broadcasts.get(key)) is None or (reader := broadcast.subscribe()) is None:
+        broadcast = track_file_broadcasts[key] = Broadcast(functools.partial(open_upstream_track_file, gateway_track, formats), **TRACK_FILE_BROADCAST)
+        broadcast.add_done_callback(lambda broadcast: track_file_broadcasts.pop(key) if track_file_broadcasts.get(key) is broadcast else None)
+        reader = broadcast.subscribe()
+        track_file_streams.inc(kind='upstream')
+    else:
+        track_file_streams.inc(kind='coalesced')
+
+    try:
+        format_, size = await asyncio.shield(broadcast.opened)
+        async with aclosing(read_track_file_broadcast(reader, gateway_track, format_)) as chunks:
+            yield format_, AsyncBytesReader(chunks, size)
+    finally:
+        reader.close()
+
+@asynccontextmanager
+async def open_upstream_track_file(gateway_track: dict, formats: list[str]) -> AsyncIterator[tuple[tuple[str, int | None], AsyncIterator[bytes]]]:
+    async with deezer.open_track(gateway_track['SNG_ID'], gateway_track['TRACK_TOKEN'], formats) as (format_, track):
+        if track_cache is None:
+            yield (format_, track.size), aiter(track)
+            return
+
+        async with aclosing(write_file_cache(aiter(track), track_cache.create(create_track_file_key(gateway_track, format_)), track.size)) as chunks:
+            yield (format_, track.size), chunks
+
+async def read_track_file_broadcast(reader: BroadcastReader, gateway_track: dict, format_: str) -> AsyncIterator[bytes]:
+    # Readers too slow for the others go on with their own download from where they were.
+    async with aclosing(reader.read()) as chunks:
+        async for chunk in chunks:
+            yield chunk
+
+    if reader.detached:
+        track_file_streams.inc(kind='fallback')
+        async with open_track_file(gateway_track, [format_], reader.position) as (_, track):
+            async for chunk in track:
+                yield chunk
+
+async def get_track_file_header(gateway_track: dict, format_: str) -> tuple[bytes, int | None]:
+    async def create():
+        async with open_track_file(gateway_track, [format_]) as (_, track):
+            return await read_track_file_header(track, format_), track.size
+
+    return await track_file_headers.get(create_track_file_key(gateway_track, format_), create)
+
+async def get_track_tags(gateway_track: dict, gateway_album_page: Awaitable[dict], cover_format: str, cover_size: tuple[int, int]) -> tuple[dict, bytes]:
+    gateway_album_page, api_track, cover_data = await gather_cancel(
+        gateway_album_page,
+        deezer.get_api_track(gateway_track['SNG_ID']),
+        get_image('cover', bytes.fromhex(gateway_track['ALB_PICTURE']), cover_size, cover_format)
+    )
 
-    gateway_track_page = await deezer.get_gateway_track_page(id_)
-    gateway_track = gateway_track_page['DATA']
+    gateway_album = gateway_album_page['DATA']
+    gateway_album_tracks = gateway_album_page['SONGS']['data']
 
-    gateway_album_page, api_track, track_data, cover_data = await gather_cancel(
-        deezer.get_gateway_album_page(gateway_track['ALB_ID']),
-        deezer.get_api_track(gateway_track['SNG_ID']),
-        deezer.download_track(gateway_track['SNG_ID'], gateway_track['TRACK_TOKEN'], format_),
-        download_gateway_track_album_cover(bytes.fromhex(gateway_track['ALB_PICTURE']), tuple(map(int, cover_size.split('x', 1))), cover_format)
+    return create_track_tags({**parse_track(gateway_track, api_track), 'album': parse_album(gateway_album, gateway_album_tracks)}), cover_data
+
+async def open_tagged_track_file(stack: AsyncExitStack, gateway_track: dict, gateway_album_page: Awaitable[dict], formats: list[str], cover_format: str, cover_size: tuple[int, int]) -> tuple[str, bytes, AsyncBytesReader, int | None, str]:
+    (format_, track), (tags, cover_data) = await gather_cancel(
+        stack.enter_async_context(open_track_file(gateway_track, formats)),
+        get_track_tags(gateway_track, gateway_album_page, cover_format, cover_size)
     )
 
+    header = await read_track_file_header(track, format_)
+    track_file_headers.set(create_track_file_key(gateway_track, format_), (header, track.size))
+    tagged_header = await tag_track_file_header(header, format_, tags, cover_data, cover_format)
+
+    size = None if track.size is None else track.size - len(header) + len(tagged_header)
+    return format_, tagged_header, track, size, create_track_file_etag(gateway_track, format_, tags, cover_format, cover_size)
+
+async def download_tagged_track_file(gateway_track: dict, gateway_album_page: Awaitable[dict], formats: list[str], cover_format: str, cover_size: tuple[int, int]) -> tuple[str, memoryview]:
+    # Track file chunks are copied once, into a buffer of the tagged file size.
+    async with AsyncExitStack() as stack:
+        format_, header, track, size, _ = await open_tagged_track_file(stack, gateway_track, gateway_album_page, formats, cover_format, cover_size)
+        if size is None:
+            data = bytearray(header)
+            async for chunk in track:
+                data += chunk
+            return format_, memoryview(data)
+
+        data = memoryview(bytearray(size))
+        data[:len(header)] = header
+        i = len(header)
+        async for chunk in track:
+            data[i:i + len(chunk)] = chunk
+            i += len(chunk)
+        return format_, data[:i]
+
+async def download_tagged_track_files(files: list[tuple[str, dict, Callable[[], Awaitable[dict]]]], format_: str, cover_format: str, cover_size: tuple[int, int]) -> AsyncIterator[tuple[str, memoryview]]:
+    # Each track file is reserved in the memory budget from its download until it has been consumed.
+    async def download(basename, gateway_track, gateway_album_page):
+        formats = [f for f in FORMATS[FORMATS.index(format_):] if int(gateway_track.get(f'FILESIZE_{f}') or 0)]
+        reserved = await memory_budget.acquire(max((int(gateway_track[f'FILESIZE_{f}']) for f in formats), default=0) + TRACK_STREAM_MEMORY, reject=False)
+        try:
+            track_format, data = await download_tagged_track_file(gateway_track, gateway_album_page(), formats, cover_format, cover_size)
+        except BaseException:
+            memory_budget.release(reserved)
+            raise
+        return f'{basename}.{FORMATS_EXTENSIONS[track_format]}', data, reserved
+
+    def discard(task):
+        if not task.cancelled() and task.exception() is None:
+            memory_budget.release(task.result()[2])
+
+    # Tracks that fail are logged and listed in a last ARCHIVE_ERRORS_FILENAME file.
+    files = iter(files)
+    pending = set()
+    done = set()
+    basenames = {}
+    errors = []
+    downloads_in_progress.inc(type='archive')
+    try:
+        while True:
+            while len(pending) < settings.download_concurrency and (file := next(files, None)) is not None:
+                task = asyncio.create_task(download(*file))
+                basenames[task] = file[0]
+                pending.add(task)
+            if not pending:
+                break
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            while done:
+                task = done.pop()
+                if (e := task.exception()) is not None:
+                    logger.error('Downloading %s failed', basenames[task], exc_info=e)
+                    errors.append(f'{basenames[task]}: {type(e).__name__}: {e}\n')
+                    continue
+
+                filename, data, reserved = task.result()
+                try:
+                    yield filename, data
+                finally:
+                    memory_budget.release(reserved)
+
+        if errors:
+            yield ARCHIVE_ERRORS_FILENAME, ''.join(errors).encode()
+    finally:
+        downloads_in_progress.dec(type='archive')
+        for task in pending:
+            task.cancel()
+            task.add_done_callback(discard)
+        for task in done:
+            discard(task)
+
+def create_archive_basenames(basenames: list[str]) -> list[str]:
+    seen = set()
+    for i, basename in enumerate(basenames):
+        basename = sanitize_filename(basename)
+        unique = basename
+        duplicate = 0
+        while basename != '' and unique in seen:
+            unique = f'{basename}.{(duplicate := duplicate + 1)}'
+        seen.add(unique)
+        basenames[i] = unique
+    return basenames
+
+def create_attachment_headers(filename: str) -> dict:
+    return {'Content-Disposition': f"attachment; filename*=UTF-8''{urllib.parse.quote(filename)}"}
+
+@app.get('/track/{id}/download')
+async def download(id: str, format: TrackFormat, cover_format: ImageFormat, cover_size: str = Query(regex=IMAGE_SIZE_REGEX), range: str | None = Header(None), if_range: str | None = Header(None)):
+    id_ = id
+    format_ = format
+    range_ = range
+    cover_size = tuple(map(int, cover_size.split('x', 1)))
+
+    stack = AsyncExitStack()
+    try:
+        await stack.enter_async_context(memory_budget.reserve(TRACK_STREAM_MEMORY))
+
+        gateway_track_page = await deezer.get_gateway_track_page(id_)
+        gateway_track = gateway_track_page['DATA']
+        gateway_album_page = deezer.get_gateway_album_page(gateway_track['ALB_ID'])
+
+        if range_ is None:
+            _, header, track, size, etag = await open_tagged_track_file(stack, gateway_track, gateway_album_page, [format_], cover_format, cover_size)
+            headers = {'Accept-Ranges': 'bytes', 'ETag': etag}
+            if size is not None:
+                headers['Content-Length'] = str(size)
+            return StreamingResponse(stream_track_file(stack, header, track), headers=headers)
+
+        # The tagged file is the tagged header followed by the original file from the end of its header,
+        # only the part of it that is in range is requested upstream.
+        (header, file_size), (tags, cover_data) = await gather_cancel(
+            get_track_file_header(gateway_track, format_),
+            get_track_tags(gateway_track, gateway_album_page, cover_format, cover_size)
+        )
+        tagged_header = await tag_track_file_header(header, format_, tags, cover_data, cover_format)
+        etag = create_track_file_etag(gateway_track, format_, tags, cover_format, cover_size)
+        headers = {'Accept-Ranges': 'bytes', 'ETag': etag}
+
+        byte_range = None
+        if file_size is not None and if_range in (None, etag):
+            size = file_size - len(header) + len(tagged_header)
+            byte_range = parse_byte_range(range_, size)
+
+        if byte_range is None:
+            _, track = await stack.enter_async_context(open_track_file(gateway_track, [format_], len(header)))
+            if track.size is not None:
+                headers['Content-Length'] = str(len(tagged_header) + track.size)
+            return StreamingResponse(stream_track_file(stack, tagged_header, track), headers=headers)
+
+        start, end = byte_range
+        if start >= end:
+            await stack.aclose()
+            return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{size}'})
+
+        track = None
+        if end > len(tagged_header):
+            _, track = await stack.enter_async_context(open_track_file(gateway_track, [format_], max(start - len(tagged_header), 0) + len(header), end - len(tagged_header) + len(header)))
+
+        headers['Content-Length'] = str(end - start)
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        return StreamingResponse(stream_track_file(stack, tagged_header[start:end], track), status_code=206, headers=headers)
+    except BaseException:
+        await stack.aclose()
+        raise
+
+async def get_album_archive_files(id_: str) -> tuple[str, list[tuple[str, dict, Callable[[], Awaitable[dict]]]]]:
+    gateway_album_page = await deezer.get_gateway_album_page(id_)
     gateway_album = gateway_album_page['DATA']
     gateway_album_tracks = gateway_album_page['SONGS']['data']
 
-    tags = create_track_tags({**parse_track(gateway_track, api_track), 'album': parse_album(gateway_album, gateway_album_tracks)})
+    album = parse_album(gateway_album, gateway_album_tracks)
+    tracks = [parse_track(t, None) for t in gateway_album_tracks]
 
-    cover_image = Image.open(BytesIO(cover_data))
-    if cover_image.mode == 'RGBA' and (255, 255) == cover_image.getchannel('A').getextrema():
-        cover_image = cover_image.convert('RGB')
-        output = BytesIO()
-        cover_image.save(output, cover_format)
-        cover_data = output.getvalue()
-    cover_image.format = cover_format.replace('jpg', 'jpeg').upper()
+    basenames = create_archive_basenames([(f'CD{t["disk_number"]} - ' if album['disk_count'] > 1 else '') + f'{t["track_number"]:02} - {t["title"]}' for t in tracks])
+    files = [(basename, t, functools.partial(deezer.get_gateway_album_page, t['ALB_ID'])) for basename, t in zip(basenames, gateway_album_tracks)]
 
-    match format_.partition('_')[0]:
-        case 'FLAC':
-            f = flac.FLAC(BytesIO(track_data))
-            f.clear()
-            f.clear_pictures()
-        case 'MP3':
-            f = mp3.MP3(BytesIO(track_data))
-            f.clear()
-        case _:
-            raise NotImplementedError()
+    return sanitize_filename(f'{", ".join(a["name"] for a in album["artists"])} - {album["title"]}'), files
+
+async def get_playlist_archive_files(id_: str) -> tuple[str, list[tuple[str, dict, Callable[[], Awaitable[dict]]]]]:
+    async with aclosing(deezer.get_gateway_playlist_pages(id_)) as gateway_playlist_pages:
+        gateway_playlist_pages = [p async for p in gateway_playlist_pages]
+    gateway_playlist = gateway_playlist_pages[0]['DATA']
+    gateway_playlist_tracks = [t for p in gateway_playlist_pages for t in p['SONGS']['data']]
+
+    playlist = parse_playlist(gateway_playlist)
+    tracks = [parse_track(t, None) for t in gateway_playlist_tracks]
+
+    basenames = create_archive_basenames([f'{", ".join(a["name"] for a in t["artists"])} - {t["title"]}' for t in tracks])
+    files = [(basename, t, functools.partial(deezer.get_gateway_album_page, t['ALB_ID'])) for basename, t in zip(basenames, gateway_playlist_tracks)]
+
+    return sanitize_filename(playlist['title']), files
 
-    if f.tags is None:
-        f.add_tags()
-    add_tags(f, tags)
-    add_tags_picture(f, cover_data, cover_image, id3.PictureType.COVER_FRONT, '')
+@app.get('/album/{id}/download')
+async def album_download(id: str, format: TrackFormat, cover_format: ImageFormat, cover_size: str = Query(regex=IMAGE_SIZE_REGEX)):
+    id_ = id
+    format_ = format
+
+    upstream_priority.set('bulk')
+    memory_budget.check()
 
-    output = BytesIO(track_data)
-    f.save(output)
-    track_data = output.getvalue()
+    basename, files = await get_album_archive_files(id_)
+    return StreamingResponse(
+        stream_zip(download_tagged_track_files(files, format_, cover_format, tuple(map(int, cover_size.split('x', 1))))),
+        media_type='application/zip',
+        headers=create_attachment_headers(f'{basename}.zip'))
+
+@app.get('/playlist/{id}/download')
+async def playlist_download(id: str, format: TrackFormat, cover_format: ImageFormat, cover_size: str = Query(regex=IMAGE_SIZE_REGEX)):
+    id_ = id
+    format_ = format
 
-    return Response(content=track_data)
+    upstream_priority.set('bulk')
+    memory_budget.check()
+
+    basename, files = await get_playlist_archive_files(id_)
+    return StreamingResponse(
+        stream_zip(download_tagged_track_files(files, format_, cover_format, tuple(map(int, cover_size.split('x', 1))))),
+        media_type='application/zip',
+        headers=create_attachment_headers(f'{basename}.zip'))
+
+async def run_job(job: dict, path: str, progress: Callable[[int, int | None], None]) -> str:
+    params = job['params']
+    cover_size = tuple(map(int, params['cover_size'].split('x', 1)))
+
+    upstream_priority.set('bulk')
+    upstream_client.set(f'job-{job["id"]}')
+    current_deezer_client.set(deezer.select())
+
+    with open(path, 'wb') as f:
+        if params['type'] == 'track':
+            gateway_track_page = await deezer.get_gateway_track_page(params['id'])
+            gateway_track = gateway_track_page['DATA']
+            track = parse_track(gateway_track, None)
+
+            async with AsyncExitStack() as stack:
+                await stack.enter_async_context(memory_budget.reserve(TRACK_STREAM_MEMORY, reject=False))
+                format_, header, track_file, size, _ = await open_tagged_track_file(stack, gateway_track, deezer.get_gateway_album_page(gateway_track['ALB_ID']), [params['format']], params['cover_format'], cover_size)
+                f.write(header)
+                async for chunk in track_file:
+                    f.write(chunk)
+                    progress(f.tell(), size)
+
+            return sanitize_filename(f'{", ".join(a["name"] for a in track["artists"])} - {track["title"]}.{FORMATS_EXTENSIONS[format_]}')
+
+        basename, files = await (get_album_archive_files if params['type'] == 'album' else get_playlist_archive_files)(params['id'])
+
+        async def count(downloads: AsyncIterator[tuple[str, memoryview]]) -> AsyncIterator[tuple[str, memoryview]]:
+            done = 0
+            async for download in downloads:
+                if download[0] != ARCHIVE_ERRORS_FILENAME:
+                    progress(done := done + 1, len(files))
+                yield download
+
+        progress(0, len(files))
+        async for chunk in stream_zip(count(download_tagged_track_files(files, params['format'], params['cover_format'], cover_size))):
+            f.write(chunk)
+
+        return f'{basename}.zip'
+
+class JobParams(BaseModel):
+    type: Literal['track', 'album', 'playlist']
+    id: str
+    format: TrackFormat
+    cover_format: ImageFormat
+    cover_size: str = Field(regex=IMAGE_SIZE_REGEX)
+
+@app.post('/jobs')
+async def create_job(params: JobParams):
+    return jobs.submit(params.dict())
+
+@app.get('/jobs')
+async def list_jobs():
+    return jobs.list()
+
+@app.get('/jobs/{id}')
+async def get_job(id: str):
+    if (job := jobs.get(id)) is None:
+        return Response(status_code=404)
+    return job
+
+@app.delete('/jobs/{id}')
+async def delete_job(id: str):
+    return Response(status_code=204 if jobs.delete(id) else 404)
+
+@app.get('/jobs/{id}/events')
+async def job_events(id: str):
+    if jobs.get(id) is None:
+        return Response(status_code=404)
+    return StreamingResponse(stream_sse(jobs.subscribe(id)), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.get('/jobs/{id}/download')
+async def job_download(id: str):
+    if (job := jobs.get(id)) is None or job['state'] != 'done':
+        return Response(status_code=404)
+    return FileResponse(jobs.artifact_path(id), media_type=mimetypes.guess_type(job['filename'])[0] or 'application/octet-stream', headers=create_attachment_headers(job['filename']))
@@ -0,0 +1,41 @@
+import io
+import zipfile
+from typing import AsyncIterator, Iterator
+
+
+ZIP_CHUNK_SIZE = 1024 ** 2
+
+
+class ZipOutput(io.RawIOBase):
+    # File data written as memoryviews is kept by reference and only copied in ZIP_CHUNK_SIZE pieces when popped,
+    # the buffers behind them must not change until then.
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(b.cast('B') if isinstance(b, memoryview) else b if isinstance(b, bytes) else bytes(b))
+        return len(self._chunks[-1])
+
+    def pop(self) -> Iterator[bytes]:
+        chunks, self._chunks = self._chunks, []
+        for chunk in chunks:
+            if isinstance(chunk, bytes):
+                yield chunk
+                continue
+            for i in range(0, len(chunk), ZIP_CHUNK_SIZE):
+                yield bytes(chunk[i:i + ZIP_CHUNK_SIZE])
+
+
+async def stream_zip(files: AsyncIterator[tuple[str, bytes | memoryview]]) -> AsyncIterator[bytes]:
+    output = ZipOutput()
+    archive = zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    async for filename, data in files:
+        archive.writestr(filename, data)
+        for chunk in output.pop():
+            yield chunk
+    archive.close()
+    for chunk in output.pop():
+        yield chunk
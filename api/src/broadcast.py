@@ -0,0 +1,121 @@
+import asyncio
+from collections import deque
+from contextlib import AbstractAsyncContextManager
+from typing import Any, AsyncIterator, Callable
+
+
+class Broadcast:
+    # Reads a stream once, in a task, for any number of readers. The stream is opened by `open_`, which yields
+    # some info (available from `opened`) and the chunks. Reading pauses while the slowest reader has
+    # `max_buffer` bytes left to read, after `timeout` seconds the slowest readers are detached if others are
+    # ahead, so that those can go on (detached readers stop at the position they reached). Read chunks are kept,
+    # up to `max_buffer` bytes, for readers that subscribe later, which can only subscribe while the first chunk
+    # is kept.
+    def __init__(self, open_: Callable[[], AbstractAsyncContextManager[tuple[Any, AsyncIterator[bytes]]]], max_buffer: int, timeout: float):
+        self._open = open_
+        self._max_buffer = max_buffer
+        self._timeout = timeout
+        self._chunks = deque()
+        self._first = 0
+        self._size = 0
+        self._end = 0
+        self._readers = set()
+        self._closed = False
+        self._finished = False
+        self._error = None
+        self._changed = asyncio.Event()
+
+        self.opened = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._read())
+
+    def add_done_callback(self, callback: Callable[['Broadcast'], None]):
+        self._task.add_done_callback(lambda _: callback(self))
+
+    def subscribe(self) -> 'BroadcastReader | None':
+        if self._first > 0 or self._closed and not self._finished:
+            return None
+        reader = BroadcastReader(self)
+        self._readers.add(reader)
+        return reader
+
+    def _unsubscribe(self, reader: 'BroadcastReader'):
+        self._readers.discard(reader)
+        if not self._readers and not self._closed:
+            self._task.cancel()
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _trim(self):
+        position = min((r.index for r in self._readers), default=self._first + len(self._chunks))
+        while self._first < position and self._size > self._max_buffer:
+            self._size -= len(self._chunks.popleft())
+            self._first += 1
+
+    async def _read(self):
+        loop = asyncio.get_running_loop()
+        try:
+            async with self._open() as (info, chunks):
+                self.opened.set_result(info)
+                async for chunk in chunks:
+                    self._chunks.append(chunk)
+                    self._size += len(chunk)
+                    self._end += len(chunk)
+                    self._notify()
+                    deadline = loop.time() + self._timeout
+                    while self._readers and self._end - min(r.position for r in self._readers) >= self._max_buffer:
+                        try:
+                            await asyncio.wait_for(self._changed.wait(), deadline - loop.time())
+                        except asyncio.TimeoutError:
+                            # Only readers holding others back are detached, a lone reader just sets the pace.
+                            position = min(r.position for r in self._readers)
+                            if any(r.position > position for r in self._readers):
+                                for reader in [r for r in self._readers if r.position == position]:
+                                    reader.detached = True
+                                    self._unsubscribe(reader)
+                            deadline = loop.time() + self._timeout
+                    self._trim()
+            self._finished = True
+        except Exception as e:
+            self._error = e
+            if not self.opened.done():
+                self.opened.set_exception(e)
+        finally:
+            if not self.opened.done():
+                self.opened.cancel()
+            self._closed = True
+            self._notify()
+
+
+class BroadcastReader:
+    def __init__(self, broadcast: Broadcast):
+        self._broadcast = broadcast
+        self.index = 0
+        self.position = 0
+        self.detached = False
+
+    def close(self):
+        self._broadcast._unsubscribe(self)
+
+    async def read(self) -> AsyncIterator[bytes]:
+        broadcast = self._broadcast
+        try:
+            while not self.detached:
+                if self.index < broadcast._first + len(broadcast._chunks):
+                    chunk = broadcast._chunks[self.index - broadcast._first]
+                    self.index += 1
+                    self.position += len(chunk)
+                    broadcast._notify()
+                    yield chunk
+                elif broadcast._closed:
+                    if broadcast._error is not None:
+                        raise broadcast._error
+                    if not broadcast._finished:
+                        raise Exception('broadcast cancelled')
+                    return
+                else:
+                    await broadcast._changed.wait()
+        finally:
+            self.close()
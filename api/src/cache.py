@@ -0,0 +1,232 @@
+import os
+import mmap
+import fcntl
+import time
+import asyncio
+import hashlib
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, Iterator
+import orjson
+from .shared import SharedState
+
+
+class MemoryCache:
+    # With a shared state, misses are looked up there (under `namespace`) before being created, and created values
+    # are stored there, serialized with `dumps`, for the other processes.
+    def __init__(self, max_size: int, ttl: float, shared_state: SharedState | None = None, namespace: str = '', dumps: Callable[[Any], bytes] = orjson.dumps, loads: Callable[[bytes], Any] = orjson.loads):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._shared_state = shared_state
+        self._namespace = namespace
+        self._dumps = dumps
+        self._loads = loads
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.shared_hits = 0
+
+    @property
+    def size(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return dict(size=self.size, max_size=self._max_size, hits=self.hits, misses=self.misses, coalesced=self.coalesced, shared_hits=self.shared_hits)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._pending or ((entry := self._entries.get(key)) is not None and entry[0] > time.monotonic())
+
+    async def get(self, key: Hashable, create: Callable[[], Awaitable[Any]]) -> Any:
+        if (entry := self._entries.get(key)) is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+
+        if (task := self._pending.get(key)) is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = self._pending[key] = asyncio.ensure_future(create() if self._shared_state is None else self._create_shared(key, create))
+            task.add_done_callback(lambda task: self._set(key, task))
+
+        return await asyncio.shield(task)
+
+    def set(self, key: Hashable, value: Any):
+        self._entries[key] = (time.monotonic() + self._ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    async def _create_shared(self, key: Hashable, create: Callable[[], Awaitable[Any]]) -> Any:
+        # The shared state is only an optimization, its errors fall back to creating and not sharing the value.
+        shared_key = f'{self._namespace}:{key if isinstance(key, str) else orjson.dumps(key).decode()}'
+        try:
+            if (data := await self._shared_state.get(shared_key)) is not None:
+                self.shared_hits += 1
+                return self._loads(data)
+        except Exception:
+            pass
+
+        value = await create()
+        try:
+            await self._shared_state.set(shared_key, self._dumps(value), self._ttl)
+        except Exception:
+            pass
+        return value
+
+    def _set(self, key: Hashable, task: asyncio.Future):
+        del self._pending[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+
+        self.set(key, task.result())
+
+
+class FileCache:
+    # The directory can be shared by several processes: files added by the others are found when opened, and the
+    # index is rescanned from the directory at most every RESCAN_INTERVAL seconds, when files are added, under a
+    # file lock so that the size bound holds for all of them.
+    RESCAN_INTERVAL = 10
+    STALE_TMP_AGE = 60 * 60
+
+    def __init__(self, path: str, max_size: int):
+        self._path = path
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._scanned = 0.0
+
+        os.makedirs(self._path, exist_ok=True)
+        self._lock = open(os.path.join(self._path, '.lock'), 'a')
+        with self._locked():
+            self._scan()
+            self._evict()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __contains__(self, key: str) -> bool:
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return name in self._entries or os.path.exists(os.path.join(self._path, name))
+
+    def open(self, key: str) -> mmap.mmap | None:
+        name = hashlib.sha256(key.encode()).hexdigest()
+        path = os.path.join(self._path, name)
+        try:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path)
+        except FileNotFoundError:
+            self._size -= self._entries.pop(name, 0)
+            return None
+        except (OSError, ValueError):
+            self._remove(name)
+            return None
+
+        self._size += len(data) - self._entries.pop(name, 0)
+        self._entries[name] = len(data)
+        return data
+
+    def create(self, key: str) -> 'FileCacheWriter':
+        fd, path = tempfile.mkstemp(dir=self._path, suffix='.tmp')
+        return FileCacheWriter(self, hashlib.sha256(key.encode()).hexdigest(), open(fd, 'wb'), path)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+
+    def _scan(self):
+        # Least recently used first, files are touched when opened. Temporary files of other processes are only
+        # removed once stale.
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self._path):
+            try:
+                stat = entry.stat()
+                if entry.name.endswith('.tmp'):
+                    if now - stat.st_mtime > self.STALE_TMP_AGE:
+                        os.remove(entry.path)
+                elif len(entry.name) == 64:
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+            except FileNotFoundError:
+                pass
+        self._entries = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self._size = sum(self._entries.values())
+        self._scanned = time.monotonic()
+
+    def _commit(self, name: str, path: str, size: int):
+        with self._locked():
+            os.replace(path, os.path.join(self._path, name))
+            if time.monotonic() > self._scanned + self.RESCAN_INTERVAL:
+                self._scan()
+            else:
+                self._size += size - self._entries.pop(name, 0)
+                self._entries[name] = size
+            self._evict()
+
+    def _remove(self, name: str):
+        self._size -= self._entries.pop(name, 0)
+        try:
+            os.remove(os.path.join(self._path, name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self._size > self._max_size and self._entries:
+            self._remove(next(iter(self._entries)))
+
+
+class FileCacheWriter:
+    def __init__(self, cache: FileCache, name: str, f, path: str):
+        self._cache = cache
+        self._name = name
+        self._f = f
+        self._path = path
+        self.size = 0
+
+    def write(self, data: bytes):
+        self._f.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        self._f.close()
+        self._cache._commit(self._name, self._path, self.size)
+        self._path = None
+
+    def abort(self):
+        self._f.close()
+        if self._path is not None:
+            os.remove(self._path)
+            self._path = None
+
+
+async def read_mmap(data: mmap.mmap, chunk_size: int, start: int = 0, end: int | None = None) -> AsyncIterator[bytes]:
+    end = len(data) if end is None else min(end, len(data))
+    try:
+        for i in range(start, end, chunk_size):
+            yield data[i:min(i + chunk_size, end)]
+    finally:
+        data.close()
+
+
+async def write_file_cache(chunks: AsyncIterator[bytes], writer: FileCacheWriter, size: int | None) -> AsyncIterator[bytes]:
+    try:
+        async for chunk in chunks:
+            writer.write(chunk)
+            yield chunk
+        if size is None or writer.size == size:
+            writer.commit()
+    finally:
+        writer.abort()
@@ -1,11 +1,100 @@
 import asyncio
+import re
+from typing import AsyncIterator
 
 
 async def gather_cancel(*tasks, **kwargs):
-    tasks = [task if isinstance(task, asyncio.Task) else asyncio.create_task(task) for task in tasks]
+    tasks = [asyncio.ensure_future(task) for task in tasks]
     try:
         return await asyncio.gather(*tasks, **kwargs)
     except BaseException as e:
         for task in tasks:
             task.cancel()
         raise
+
+
+class AsyncBytesReader:
+    def __init__(self, chunks: AsyncIterator[bytes], size: int | None = None):
+        self.size = size
+        self._chunks = aiter(chunks)
+        self._buffer = bytearray()
+
+    async def read(self, n: int = -1) -> bytes:
+        while n < 0 or len(self._buffer) < n:
+            try:
+                self._buffer += await anext(self._chunks)
+            except StopAsyncIteration:
+                break
+        n = len(self._buffer) if n < 0 else min(n, len(self._buffer))
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    async def readexactly(self, n: int) -> bytes:
+        data = await self.read(n)
+        if len(data) < n:
+            raise asyncio.IncompleteReadError(data, n)
+        return data
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        if self._buffer:
+            yield bytes(self._buffer)
+            self._buffer.clear()
+        async for chunk in self._chunks:
+            yield chunk
+
+
+async def slice_chunks(chunks: AsyncIterator[bytes], start: int, size: int | None = None) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        if start:
+            n = min(start, len(chunk))
+            chunk = chunk[n:]
+            start -= n
+        if size is not None:
+            chunk = chunk[:size]
+            size -= len(chunk)
+        if chunk:
+            yield chunk
+        if size == 0:
+            break
+
+
+def parse_byte_range(value: str, size: int) -> tuple[int, int] | None:
+    # Single ranges only, anything else is ignored and served in full. An empty result is unsatisfiable.
+    if (match := re.fullmatch(r'bytes=(\d*)-(\d*)', value.strip())) is None or match[1] == match[2] == '':
+        return None
+    if match[1] == '':
+        return max(size - int(match[2]), 0), size
+    if match[2] != '' and int(match[2]) < int(match[1]):
+        return None
+    return int(match[1]), size if match[2] == '' else min(int(match[2]) + 1, size)
+
+
+def sanitize_filename(s: str) -> str:
+    s = re.sub(r'[/?<>\\:*|"\x00-\x1f\x80-\x9f]', '', s)
+    s = re.sub(r'^\.+$', '', s)
+    s = re.sub(r'^(con|prn|aux|nul|com[0-9]|lpt[0-9])(\..*)?$', '', s, flags=re.IGNORECASE)
+    s = re.sub(r'[. ]+$', '', s)
+    return s.encode()[:255].decode(errors='ignore')
+
+
+def parse_fields(value: str | None) -> dict | None:
+    # 'title,album.title,album.deezer.id' -> {'title': {}, 'album': {'title': {}, 'deezer': {'id': {}}}}
+    if value is None:
+        return None
+    fields = {}
+    for path in value.split(','):
+        node = fields
+        for key in path.strip().split('.'):
+            node = node.setdefault(key, {})
+    return fields
+
+
+def select_fields(value, fields: dict | None):
+    if fields is None:
+        return value
+    if isinstance(value, list):
+        return [select_fields(v, fields) for v in value]
+    if not isinstance(value, dict):
+        return value
+    return {k: select_fields(value[k], f) if f else value[k] for k, f in fields.items() if k in value}
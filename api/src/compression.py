@@ -0,0 +1,53 @@
+import zlib
+from starlette.datastructures import Headers, MutableHeaders
+
+
+class CompressionMiddleware:
+    # Gzips JSON and NDJSON responses (not track files or archives, which do not compress) when the client accepts it.
+    # Responses sent in one piece are compressed from `minimum_size` bytes, streamed responses are flushed
+    # after each chunk so that they are still streamed.
+    CONTENT_TYPES = {'application/json', 'application/x-ndjson'}
+
+    def __init__(self, app, minimum_size: int = 1024, level: int = 6):
+        self._app = app
+        self._minimum_size = minimum_size
+        self._level = level
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or 'gzip' not in Headers(scope=scope).get('accept-encoding', ''):
+            await self._app(scope, receive, send)
+            return
+
+        start = None
+        compressor = None
+
+        async def send_compressed(message):
+            nonlocal start, compressor
+            if message['type'] == 'http.response.start':
+                headers = Headers(raw=message['headers'])
+                if headers.get('content-type', '').partition(';')[0] in self.CONTENT_TYPES and 'content-encoding' not in headers:
+                    start = message
+                    return
+            elif message['type'] == 'http.response.body' and (start is not None or compressor is not None):
+                body = message.get('body', b'')
+                more_body = message.get('more_body', False)
+                if compressor is None:
+                    if not more_body and len(body) < self._minimum_size:
+                        await send(start)
+                        start = None
+                    else:
+                        compressor = zlib.compressobj(self._level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+                        headers = MutableHeaders(raw=start['headers'])
+                        headers['Content-Encoding'] = 'gzip'
+                        headers.add_vary_header('Accept-Encoding')
+                        del headers['Content-Length']
+                        await send(start)
+                        start = None
+
+                if compressor is not None:
+                    body = compressor.compress(body) + compressor.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+                    message = {**message, 'body': body}
+
+            await send(message)
+
+        await self._app(scope, receive, send_compressed)
@@ -1,22 +1,25 @@
 import re
-import itertools
 import hashlib
 import asyncio
-from typing import AsyncIterator
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable
 import aiohttp
+import orjson
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 
 
-def create_deezer_client_session() -> aiohttp.ClientSession:
+def create_deezer_client_session(**kwargs) -> aiohttp.ClientSession:
     return aiohttp.ClientSession(
+        json_serialize=lambda o: orjson.dumps(o).decode(),
         skip_auto_headers=['User-Agent'],
         headers={
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36',
             'Cache-Control': 'max-age=0',
             'Accept': '*/*',
             'Accept-Language': 'en-US,en;q=0.5',
-        })
+        },
+        **kwargs)
 
 
 async def login_deezer_session(session: aiohttp.ClientSession, email: str, password_md5: bytes, client_id: str, client_secret: str):
@@ -31,7 +34,7 @@ async def login_deezer_session(session: aiohttp.ClientSession, email: str, passw
                 'hash': hashlib.md5(''.join([client_id, email, password_md5, client_secret]).encode()).hexdigest()
             }) as response:
         response.raise_for_status()
-        response = await response.json()
+        response = orjson.loads(await response.read())
 
     if 'error' in response:
         raise Exception(response)
@@ -55,7 +58,7 @@ async def call_deezer_gateway(session: aiohttp.ClientSession, method: str, data:
             },
             json=data) as response:
         response.raise_for_status()
-        response = await response.json()
+        response = orjson.loads(await response.read())
 
     if response['error']:
         raise Exception(response)
@@ -65,14 +68,14 @@ async def call_deezer_gateway(session: aiohttp.ClientSession, method: str, data:
 async def call_deezer_api(session: aiohttp.ClientSession, path: str) -> dict:
     async with session.get(f'https://api.deezer.com/2.0/{path}') as response:
         response.raise_for_status()
-        response = await response.json()
+        response = orjson.loads(await response.read())
 
     if 'error' in response:
         raise Exception(response)
     return response
 
 
-async def get_deezer_track_file_url(session: aiohttp.ClientSession, track_token: str, format_: str, license_token: str) -> str:
+async def get_deezer_track_file_urls(session: aiohttp.ClientSession, track_tokens: list[str], formats: list[str], license_token: str) -> list[dict]:
     async with session.post(
             'https://media.deezer.com/v1/get_url',
             json={
@@ -80,38 +83,139 @@ async def get_deezer_track_file_url(session: aiohttp.ClientSession, track_token:
                 'media': [
                     {
                         'type': 'FULL',
-                        'formats': [
-                            {'cipher': 'BF_CBC_STRIPE', 'format': format_}
-                        ]
+                        'formats': [{'cipher': 'BF_CBC_STRIPE', 'format': format_} for format_ in formats]
                     }
                 ],
-                'track_tokens': [track_token]
+                'track_tokens': track_tokens
             }) as response:
         response.raise_for_status()
-        response = await response.json()
+        response = orjson.loads(await response.read())
+
+    return response['data']
+
 
-    response = response['data'][0]
+async def get_deezer_track_file_url(session: aiohttp.ClientSession, track_token: str, format_: str, license_token: str) -> str:
+    response = (await get_deezer_track_file_urls(session, [track_token], [format_], license_token))[0]
     if 'errors' in response:
         raise Exception(response)
     return response['media'][0]['sources'][0]['url']
 
 
-async def decrypt_deezer_track_file_http_stream(track_id: str, stream: aiohttp.StreamReader, secret: bytes) -> AsyncIterator[bytes]:
-    md5 = hashlib.md5(track_id.encode()).hexdigest().encode()
-    key = bytes(t[0] ^ t[1] ^ t[2] for t in zip(secret, md5[:16], md5[16:]))
-    iv = bytes(range(8))
-    cipher = Cipher(algorithms.Blowfish(key), modes.CBC(iv), backend=default_backend())
-
-    for i in itertools.count():
-        try:
-            chunk = await stream.readexactly(2048)
-            if i % 3 == 0:
-                decryptor = cipher.decryptor()
-                chunk = decryptor.update(chunk) + decryptor.finalize()
-            yield chunk
-        except asyncio.IncompleteReadError as e:
-            yield e.partial
-            break
+DEEZER_TRACK_FILE_BLOCK_SIZE = 2048
+DEEZER_TRACK_FILE_STRIPE = 3
+DEEZER_TRACK_FILE_BUFFER_SIZE = DEEZER_TRACK_FILE_BLOCK_SIZE * DEEZER_TRACK_FILE_STRIPE * 64
+
+
+class DeezerTrackFileDecryptor:
+    IV = bytes(range(8))
+
+    def __init__(self, track_id: str, secret: bytes):
+        md5 = hashlib.md5(track_id.encode()).hexdigest().encode()
+        self.__setstate__(bytes(t[0] ^ t[1] ^ t[2] for t in zip(secret, md5[:16], md5[16:])))
+
+    def __getstate__(self) -> bytes:
+        # A copy sent to a worker process starts from a fresh CBC context, which decrypt() handles like any other.
+        return self._key
+
+    def __setstate__(self, key: bytes):
+        self._key = key
+        self._decryptor = Cipher(algorithms.Blowfish(key), modes.CBC(self.IV), backend=default_backend()).decryptor()
+        self._previous = int.from_bytes(self.IV, 'big')
+
+    def decrypt(self, data: bytearray, index: int) -> bytearray:
+        # Decrypts in place. `data` starts at block `index`, a trailing partial block is left as is.
+        # All encrypted blocks go through one CBC context: the chaining between them is undone by fixing up
+        # the first 8 bytes of every block, since each of them was encrypted starting from a fresh IV.
+        view = memoryview(data)
+        offsets = range((-index % DEEZER_TRACK_FILE_STRIPE) * DEEZER_TRACK_FILE_BLOCK_SIZE, len(data) - DEEZER_TRACK_FILE_BLOCK_SIZE + 1, DEEZER_TRACK_FILE_BLOCK_SIZE * DEEZER_TRACK_FILE_STRIPE)
+        if not offsets:
+            return data
+
+        decrypted = self._decryptor.update(b''.join([view[o:o + DEEZER_TRACK_FILE_BLOCK_SIZE] for o in offsets]))
+
+        iv = int.from_bytes(self.IV, 'big')
+        previous = self._previous
+        for i, o in enumerate(offsets):
+            chaining = previous ^ iv
+            previous = int.from_bytes(view[o + DEEZER_TRACK_FILE_BLOCK_SIZE - 8:o + DEEZER_TRACK_FILE_BLOCK_SIZE], 'big')
+            view[o:o + DEEZER_TRACK_FILE_BLOCK_SIZE] = decrypted[i * DEEZER_TRACK_FILE_BLOCK_SIZE:(i + 1) * DEEZER_TRACK_FILE_BLOCK_SIZE]
+            if chaining:
+                view[o:o + 8] = (int.from_bytes(view[o:o + 8], 'big') ^ chaining).to_bytes(8, 'big')
+        self._previous = previous
+
+        return data
+
+
+async def decrypt_deezer_track_file_http_stream(track_id: str, stream: aiohttp.StreamReader, secret: bytes, index: int = 0, buffer_size: int = DEEZER_TRACK_FILE_BUFFER_SIZE, run: Callable[..., Awaitable] | None = None) -> AsyncIterator[memoryview]:
+    decryptor = DeezerTrackFileDecryptor(track_id, secret)
+    if run is None:
+        async def run(f, *args):
+            return f(*args)
+
+    buffer = bytearray()
+    while (data := await stream.read(buffer_size)):
+        buffer += data
+        if (size := len(buffer) - len(buffer) % DEEZER_TRACK_FILE_BLOCK_SIZE) == 0:
+            continue
+
+        chunk = buffer
+        buffer = chunk[size:]
+        del chunk[size:]
+        yield memoryview(await run(decryptor.decrypt, chunk, index))
+        index += size // DEEZER_TRACK_FILE_BLOCK_SIZE
+
+    if buffer:
+        yield memoryview(await run(decryptor.decrypt, buffer, index))
+
+
+async def read_deezer_track_file_segment(session: aiohttp.ClientSession, url: str, track_id: str, secret: bytes, start: int, end: int, run: Callable[..., Awaitable] | None = None) -> tuple[bytearray, int]:
+    async with session.get(url, headers={'Range': f'bytes={start}-{end - 1}'}) as response:
+        response.raise_for_status()
+        if response.status == 206:
+            total = int(response.headers['Content-Range'].rpartition('/')[2])
+        elif start == 0:
+            total = end = response.content_length
+        else:
+            raise Exception(response.status)
+        data = bytearray(await response.read())
+
+    if total is not None and len(data) != min(end, total) - start:
+        raise aiohttp.ClientPayloadError(f'{len(data)} != {min(end, total) - start}')
+
+    decryptor = DeezerTrackFileDecryptor(track_id, secret)
+    data = decryptor.decrypt(data, start // DEEZER_TRACK_FILE_BLOCK_SIZE) if run is None else await run(decryptor.decrypt, data, start // DEEZER_TRACK_FILE_BLOCK_SIZE)
+    return data, len(data) if total is None else total
+
+
+async def read_deezer_track_file_segments(session: aiohttp.ClientSession, url: str, track_id: str, secret: bytes, start: int, end: int | None, segment_size: int, connections: int, attempts: int = 3, retry_delay: float = 1, run: Callable[..., Awaitable] | None = None) -> AsyncIterator[tuple[bytearray, int]]:
+    # Every block is decrypted by its index alone, so segments are fetched and decrypted independently,
+    # up to `connections` at a time, and yielded in order along with the track file size.
+    async def read(start, end):
+        for i in range(attempts):
+            try:
+                return await read_deezer_track_file_segment(session, url, track_id, secret, start, end, run)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if i == attempts - 1:
+                    raise
+                await asyncio.sleep(retry_delay * 2 ** i)
+
+    segment_size = -(-segment_size // DEEZER_TRACK_FILE_BLOCK_SIZE) * DEEZER_TRACK_FILE_BLOCK_SIZE
+    data, total = await read(start, start + segment_size if end is None else min(start + segment_size, end))
+    yield data, total
+
+    end = total if end is None else min(end, total)
+    offsets = iter(range(start + len(data), end, segment_size))
+    pending = deque()
+    try:
+        while True:
+            while len(pending) < connections and (offset := next(offsets, None)) is not None:
+                pending.append(asyncio.ensure_future(read(offset, min(offset + segment_size, end))))
+            if not pending:
+                break
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
 
 
 def create_deezer_image_url(type_: str, md5: bytes, size: tuple[int, int], background_color: tuple[int, int, int] | None, quality: int, fit: bool, format_: str) -> str:
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import sqlite3
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable
+
+
+class JobQueue:
+    # Jobs are persisted in SQLite in `path`, along with their artifacts, and run by `concurrency` workers.
+    # Several processes can share `path`, only the one holding the lock on it runs jobs and the others take over
+    # when it stops. Jobs that were running when the server stopped are queued again then.
+    FINAL_STATES = ('done', 'failed')
+    PROGRESS_INTERVAL = 0.5
+    KEEPALIVE_INTERVAL = 15
+    POLL_INTERVAL = 1
+    LEADER_RETRY_INTERVAL = 5
+
+    def __init__(self, path: str, run: Callable[[dict, str, Callable[[int, int], None]], Awaitable[str]], concurrency: int, ttl: float):
+        self._path = path
+        self._run = run
+        self._concurrency = concurrency
+        self._ttl = ttl
+        self._wakeup = asyncio.Event()
+        self._leader = None
+        self._running = {}
+        self._subscribers = {}
+        self._progress_updated = {}
+
+        os.makedirs(self._path, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(self._path, 'jobs.sqlite3'), isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                params TEXT NOT NULL,
+                state TEXT NOT NULL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0,
+                total INTEGER,
+                filename TEXT,
+                size INTEGER,
+                error TEXT
+            )''')
+
+    def start(self):
+        self._expire()
+        self._leader = asyncio.create_task(self._lead())
+
+    async def aclose(self):
+        self._leader.cancel()
+        await asyncio.gather(self._leader, return_exceptions=True)
+        self._db.close()
+
+    def stats(self) -> dict:
+        counts = dict(self._db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        return dict(concurrency=self._concurrency, **{s: counts.get(s, 0) for s in ('queued', 'running', *self.FINAL_STATES)})
+
+    def artifact_path(self, id_: str) -> str:
+        return os.path.join(self._path, id_)
+
+    def get(self, id_: str) -> dict | None:
+        row = self._db.execute('SELECT * FROM jobs WHERE id = ?', (id_,)).fetchone()
+        return None if row is None else self._parse(row)
+
+    def list(self) -> list[dict]:
+        return [self._parse(row) for row in self._db.execute('SELECT * FROM jobs ORDER BY created')]
+
+    def submit(self, params: dict) -> dict:
+        id_ = uuid.uuid4().hex
+        now = time.time()
+        self._db.execute('INSERT INTO jobs (id, params, state, created, updated) VALUES (?, ?, ?, ?, ?)', (id_, json.dumps(params), 'queued', now, now))
+        self._wakeup.set()
+        return self.get(id_)
+
+    def delete(self, id_: str) -> bool:
+        if (task := self._running.pop(id_, None)) is not None:
+            task.cancel()
+        deleted = self._db.execute('DELETE FROM jobs WHERE id = ?', (id_,)).rowcount > 0
+        for path in (self.artifact_path(id_), self.artifact_path(id_) + '.tmp'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._notify(id_)
+        return deleted
+
+    async def subscribe(self, id_: str) -> AsyncIterator[dict | None]:
+        # Yields the job, then the job again each time it is updated until it is finished or deleted,
+        # or None when it was not updated for a while. Updates made in this process wake subscribers up,
+        # those made by another process are polled.
+        wakeup = asyncio.Event()
+        self._subscribers.setdefault(id_, set()).add(wakeup)
+        try:
+            previous = None
+            yielded = time.monotonic()
+            while True:
+                wakeup.clear()
+                if (job := self.get(id_)) is None:
+                    return
+                if job != previous:
+                    yield job
+                    previous = job
+                    yielded = time.monotonic()
+                elif time.monotonic() > yielded + self.KEEPALIVE_INTERVAL:
+                    yield None
+                    yielded = time.monotonic()
+                if job['state'] in self.FINAL_STATES:
+                    return
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self.PROGRESS_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._subscribers[id_].discard(wakeup)
+            if not self._subscribers[id_]:
+                del self._subscribers[id_]
+
+    def _parse(self, row: sqlite3.Row) -> dict:
+        return dict(row, params=json.loads(row['params']))
+
+    def _notify(self, id_: str):
+        for wakeup in self._subscribers.get(id_, ()):
+            wakeup.set()
+
+    def _update(self, id_: str, **values) -> bool:
+        # A job deleted by another process while it runs here is cancelled on its next update.
+        values['updated'] = time.time()
+        if self._db.execute(f'UPDATE jobs SET {", ".join(f"{k} = ?" for k in values)} WHERE id = ?', (*values.values(), id_)).rowcount == 0:
+            if (task := self._running.pop(id_, None)) is not None:
+                task.cancel()
+            return False
+        self._notify(id_)
+        return True
+
+    def _progress(self, id_: str, done: int, total: int | None):
+        if done != total and time.monotonic() < self._progress_updated.get(id_, 0) + self.PROGRESS_INTERVAL:
+            return
+        self._progress_updated[id_] = time.monotonic()
+        self._update(id_, done=done, total=total)
+
+    def _expire(self):
+        for row in self._db.execute('SELECT id FROM jobs WHERE state IN (?, ?) AND updated < ?', (*self.FINAL_STATES, time.time() - self._ttl)).fetchall():
+            self.delete(row['id'])
+
+    async def _lead(self):
+        with open(os.path.join(self._path, 'jobs.lock'), 'w') as f:
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(self.LEADER_RETRY_INTERVAL)
+
+            self._db.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'")
+            await asyncio.gather(*(self._work() for _ in range(self._concurrency)))
+
+    def _claim(self) -> dict | None:
+        row = self._db.execute(
+            "UPDATE jobs SET state = 'running', updated = ?, done = 0, total = NULL, error = NULL WHERE id = (SELECT id FROM jobs WHERE state = 'queued' ORDER BY created LIMIT 1) RETURNING *",
+            (time.time(),)).fetchone()
+        if row is None:
+            return None
+        self._notify(row['id'])
+        return self._parse(row)
+
+    async def _work(self):
+        # Jobs can be submitted by other processes, the queue is polled when this process did not submit any.
+        while True:
+            if (job := self._claim()) is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            id_ = job['id']
+            path = self.artifact_path(id_)
+            task = self._running[id_] = asyncio.create_task(self._run(job, path + '.tmp', lambda done, total: self._progress(id_, done, total)))
+            try:
+                filename = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if task.cancelled():
+                    continue
+                task.cancel()
+                raise
+            except Exception as e:
+                self._update(id_, state='failed', error=repr(e))
+                try:
+                    os.remove(path + '.tmp')
+                except FileNotFoundError:
+                    pass
+            else:
+                os.replace(path + '.tmp', path)
+                if not self._update(id_, state='done', filename=filename, size=os.path.getsize(path)):
+                    os.remove(path)
+            finally:
+                self._running.pop(id_, None)
+                self._progress_updated.pop(id_, None)
+            self._expire()
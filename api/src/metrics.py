@@ -0,0 +1,112 @@
+import bisect
+from typing import Callable, Iterable
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    values = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, values)) + '}'
+
+
+class Metric:
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, help_: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[k]) for k in self.labels)
+
+    def samples(self) -> Iterable[tuple[str, dict, float]]:
+        for key, value in self._values.items():
+            yield self.name, dict(zip(self.labels, key)), value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        lines.extend(f'{name}{format_labels(labels)} {value!r}' for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + value
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = float(value)
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+
+class Summary(Metric):
+    TYPE = 'summary'
+
+    def set(self, count: float, sum_: float, **labels):
+        self._values[self._key(labels)] = (float(count), float(sum_))
+
+    def samples(self) -> Iterable[tuple[str, dict, float]]:
+        for key, (count, sum_) in self._values.items():
+            labels = dict(zip(self.labels, key))
+            yield f'{self.name}_count', labels, count
+            yield f'{self.name}_sum', labels, sum_
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, help_: str, labels: Iterable[str] = (), buckets: Iterable[float] = BUCKETS):
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        if (entry := self._values.get(key)) is None:
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self) -> Iterable[tuple[str, dict, float]]:
+        for key, (counts, sum_) in self._values.items():
+            labels = dict(zip(self.labels, key))
+            total = 0
+            for bound, count in zip([*map(repr, map(float, self.buckets)), '+Inf'], counts):
+                total += count
+                yield f'{self.name}_bucket', {**labels, 'le': bound}, total
+            yield f'{self.name}_count', labels, total
+            yield f'{self.name}_sum', labels, sum_
+
+
+class MetricsRegistry:
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, f: Callable[[], Iterable[Metric]]) -> Callable[[], Iterable[Metric]]:
+        self._collectors.append(f)
+        return f
+
+    def render(self) -> str:
+        metrics = [*self._metrics, *(m for f in self._collectors for m in f())]
+        return '\n'.join(line for m in metrics for line in m.render()) + '\n'
@@ -0,0 +1,50 @@
+import asyncio
+from collections import OrderedDict
+from typing import Coroutine, Hashable
+
+
+class Prefetcher:
+    # Runs at most one prefetch per key (a new one cancels the previous one) and at most `max_tasks` prefetches,
+    # the oldest ones are cancelled first. Prefetches are cancelled after `timeout` seconds.
+    def __init__(self, max_tasks: int, timeout: float):
+        self._max_tasks = max_tasks
+        self._timeout = timeout
+        self._tasks = OrderedDict()
+
+        self.started = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+
+    def stats(self) -> dict:
+        return dict(running=len(self._tasks), max_tasks=self._max_tasks, started=self.started, completed=self.completed, cancelled=self.cancelled, failed=self.failed)
+
+    def submit(self, key: Hashable, coro: Coroutine):
+        self.cancel(key)
+        task = self._tasks[key] = asyncio.create_task(asyncio.wait_for(coro, self._timeout))
+        task.add_done_callback(lambda task: self._done(key, task))
+        self.started += 1
+        while len(self._tasks) > self._max_tasks:
+            self.cancel(next(iter(self._tasks)))
+
+    def cancel(self, key: Hashable) -> bool:
+        if (task := self._tasks.pop(key, None)) is None:
+            return False
+        task.cancel()
+        return True
+
+    async def aclose(self):
+        tasks = [*self._tasks.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if task.cancelled() or isinstance(task.exception(), asyncio.TimeoutError):
+            self.cancelled += 1
+        elif task.exception() is not None:
+            self.failed += 1
+        else:
+            self.completed += 1
@@ -0,0 +1,139 @@
+import asyncio
+import contextvars
+from collections import OrderedDict, deque
+from typing import Hashable
+from .shared import SharedState
+
+
+upstream_priority = contextvars.ContextVar('upstream_priority', default='interactive')
+upstream_client = contextvars.ContextVar('upstream_client', default=None)
+
+
+class RateScheduler:
+    PRIORITIES = ('interactive', 'bulk')
+
+    def __init__(self, max_rate: float, time_period: float = 60, shared_state: SharedState | None = None, key: str | None = None):
+        self._max_rate = max_rate
+        self._time_period = time_period
+        self._rate_per_sec = max_rate / time_period
+        self._level = 0.0
+        self._last_check = None
+        self._queues = {p: OrderedDict() for p in self.PRIORITIES}
+        self._timer = None
+
+        # With a shared state, the queues still order the requests of this process but they are granted as the
+        # bucket `key` shared with the other processes allows, the local level only tracks the requests of this process.
+        self._shared_state = shared_state
+        self._key = key
+        self._dispatcher = None
+
+        self._stats = {p: dict(acquired=0, wait_seconds=0.0, max_wait_seconds=0.0) for p in self.PRIORITIES}
+
+    def stats(self) -> dict:
+        return {
+            p: dict(
+                s,
+                queued=sum(len(q) for q in self._queues[p].values()),
+                mean_wait_seconds=s['wait_seconds'] / s['acquired'] if s['acquired'] else 0.0)
+            for p, s in self._stats.items()}
+
+    def has_capacity(self, n: float = 1) -> bool:
+        self._leak()
+        return self._level + n <= self._max_rate
+
+    def idle(self, n: float = 1) -> bool:
+        return not any(self._queues.values()) and self.has_capacity(n)
+
+    async def wait_idle(self, n: float = 1):
+        # Waits for room for `n` requests, or for an empty bucket if it holds fewer.
+        n = min(n, self._max_rate)
+        while not self.idle(n):
+            await asyncio.sleep(max(self._level + n - self._max_rate, 1) / self._rate_per_sec)
+
+    async def acquire(self, priority: str | None = None, client: Hashable = None):
+        priority = upstream_priority.get() if priority is None else priority
+        client = upstream_client.get() if client is None else client
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+
+        if self._shared_state is None and self.idle():
+            self._level += 1
+        else:
+            future = loop.create_future()
+            self._queues[priority].setdefault(client, deque()).append(future)
+            self._schedule()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if (queue := self._queues[priority].get(client)) is not None and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del self._queues[priority][client]
+                raise
+
+        wait = loop.time() - start
+        self._stats[priority]['acquired'] += 1
+        self._stats[priority]['wait_seconds'] += wait
+        self._stats[priority]['max_wait_seconds'] = max(self._stats[priority]['max_wait_seconds'], wait)
+
+    def _leak(self):
+        loop = asyncio.get_running_loop()
+        if self._last_check is not None:
+            self._level = max(self._level - (loop.time() - self._last_check) * self._rate_per_sec, 0)
+        self._last_check = loop.time()
+
+    def _pop(self) -> asyncio.Future | None:
+        while (priority := next((p for p in self.PRIORITIES if self._queues[p]), None)) is not None:
+            clients = self._queues[priority]
+            client, queue = next(iter(clients.items()))
+            future = queue.popleft()
+            if queue:
+                clients.move_to_end(client)
+            else:
+                del clients[client]
+
+            if not future.cancelled():
+                return future
+        return None
+
+    def _schedule(self):
+        if self._shared_state is not None:
+            if self._dispatcher is None:
+                self._dispatcher = asyncio.create_task(self._dispatch())
+            return
+
+        while self.has_capacity():
+            if (future := self._pop()) is None:
+                return
+            self._level += 1
+            future.set_result(None)
+
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later((self._level + 1 - self._max_rate) / self._rate_per_sec, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._schedule()
+
+    async def _dispatch(self):
+        # When the shared state is unavailable, requests are granted as the local level allows.
+        try:
+            while any(self._queues.values()):
+                try:
+                    delay = await self._shared_state.reserve(self._key, self._max_rate, self._time_period)
+                except Exception:
+                    delay = 0 if self.has_capacity() else (self._level + 1 - self._max_rate) / self._rate_per_sec
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif (future := self._pop()) is not None:
+                    self._leak()
+                    self._level += 1
+                    future.set_result(None)
+        finally:
+            self._dispatcher = None
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
@@ -0,0 +1,174 @@
+import time
+import uuid
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+
+class SharedState:
+    # State shared by the processes of the API (e.g. uvicorn workers): values with a TTL, rate limit buckets and locks.
+    LOCK_POLL_INTERVAL = 0.1
+
+    async def get(self, key: str) -> bytes | None:
+        raise NotImplementedError()
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        raise NotImplementedError()
+
+    async def reserve(self, key: str, max_rate: float, time_period: float) -> float:
+        # Takes a slot in the leaky bucket `key` and returns 0, or returns how long to wait before a slot is free.
+        raise NotImplementedError()
+
+    async def acquire_lock(self, key: str, token: str, ttl: float) -> bool:
+        raise NotImplementedError()
+
+    async def release_lock(self, key: str, token: str):
+        raise NotImplementedError()
+
+    async def aclose(self):
+        pass
+
+    @asynccontextmanager
+    async def lock(self, key: str, ttl: float) -> AsyncIterator[None]:
+        token = uuid.uuid4().hex
+        while not await self.acquire_lock(key, token, ttl):
+            await asyncio.sleep(self.LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            await self.release_lock(key, token)
+
+
+class SQLiteSharedState(SharedState):
+    # For processes on the same host, the database can be put in /dev/shm to keep it in memory.
+    # Queries run in a single thread, SQLite serializes the writes of the processes.
+    EXPIRE_INTERVAL = 60
+
+    def __init__(self, path: str):
+        self._executor = ThreadPoolExecutor(1)
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)')
+        self._expired = 0.0
+
+    async def _run(self, f, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, f, *args)
+
+    async def get(self, key: str) -> bytes | None:
+        return await self._run(self._get, key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self._run(self._set, key, value, ttl)
+
+    async def reserve(self, key: str, max_rate: float, time_period: float) -> float:
+        return await self._run(self._reserve, key, max_rate, time_period)
+
+    async def acquire_lock(self, key: str, token: str, ttl: float) -> bool:
+        return await self._run(self._acquire_lock, key, token, ttl)
+
+    async def release_lock(self, key: str, token: str):
+        await self._run(self._release_lock, key, token)
+
+    async def aclose(self):
+        await self._run(self._db.close)
+        self._executor.shutdown()
+
+    def _get(self, key: str) -> bytes | None:
+        row = self._db.execute('SELECT value FROM entries WHERE key = ? AND expires > ?', (key, time.time())).fetchone()
+        return None if row is None else row[0]
+
+    def _set(self, key: str, value: bytes, ttl: float):
+        now = time.time()
+        self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)', (key, value, now + ttl))
+        if now > self._expired + self.EXPIRE_INTERVAL:
+            self._expired = now
+            self._db.execute('DELETE FROM entries WHERE expires <= ?', (now,))
+
+    def _reserve(self, key: str, max_rate: float, time_period: float) -> float:
+        now = time.time()
+        rate_per_sec = max_rate / time_period
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._db.execute('SELECT level, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            level = 0.0 if row is None else max(row[0] - (now - row[1]) * rate_per_sec, 0)
+            if level + 1 > max_rate:
+                return (level + 1 - max_rate) / rate_per_sec
+            self._db.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)', (key, level + 1, now))
+            return 0.0
+        finally:
+            self._db.execute('COMMIT')
+
+    def _acquire_lock(self, key: str, token: str, ttl: float) -> bool:
+        now = time.time()
+        return self._db.execute(
+            'INSERT INTO entries VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires WHERE entries.expires <= ?',
+            (key, token.encode(), now + ttl, now)).rowcount > 0
+
+    def _release_lock(self, key: str, token: str):
+        self._db.execute('DELETE FROM entries WHERE key = ? AND value = ?', (key, token.encode()))
+
+
+class RedisSharedState(SharedState):
+    # Requires the redis package, works with Redis-compatible servers that run Lua scripts.
+    RESERVE_SCRIPT = '''
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local max_rate, rate_per_sec = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local bucket = redis.call('HMGET', KEYS[1], 'level', 'updated')
+        local level = 0
+        if bucket[1] then
+            level = math.max(tonumber(bucket[1]) - (now - tonumber(bucket[2])) * rate_per_sec, 0)
+        end
+        if level + 1 > max_rate then
+            return tostring((level + 1 - max_rate) / rate_per_sec)
+        end
+        redis.call('HSET', KEYS[1], 'level', tostring(level + 1), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(max_rate / rate_per_sec) + 1)
+        return '0'
+    '''
+    RELEASE_LOCK_SCRIPT = '''
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    '''
+
+    def __init__(self, url: str):
+        import redis.asyncio
+        self._redis = redis.asyncio.Redis.from_url(url)
+        self._reserve_script = self._redis.register_script(self.RESERVE_SCRIPT)
+        self._release_lock_script = self._redis.register_script(self.RELEASE_LOCK_SCRIPT)
+
+    async def get(self, key: str) -> bytes | None:
+        return await self._redis.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self._redis.set(key, value, px=max(int(ttl * 1000), 1))
+
+    async def reserve(self, key: str, max_rate: float, time_period: float) -> float:
+        return float(await self._reserve_script(keys=[key], args=[max_rate, max_rate / time_period]))
+
+    async def acquire_lock(self, key: str, token: str, ttl: float) -> bool:
+        return bool(await self._redis.set(key, token, nx=True, px=max(int(ttl * 1000), 1)))
+
+    async def release_lock(self, key: str, token: str):
+        await self._release_lock_script(keys=[key], args=[token])
+
+    async def aclose(self):
+        await self._redis.aclose()
+
+
+def create_shared_state(url: str) -> SharedState:
+    # sqlite://<path> (e.g. sqlite:///dev/shm/deezl.sqlite3) or redis://<host>[:<port>][/<db>]
+    scheme, _, rest = url.partition('://')
+    match scheme:
+        case 'sqlite':
+            return SQLiteSharedState(rest)
+        case 'redis' | 'rediss' | 'unix':
+            return RedisSharedState(url)
+        case _:
+            raise ValueError(url)
@@ -0,0 +1,89 @@
+FLAC_PADDING = 1024
+ID3_PADDING = 1024
+
+FLAC_STREAMINFO, FLAC_PADDING_BLOCK, FLAC_VORBIS_COMMENT, FLAC_PICTURE = 0, 1, 4, 6
+PICTURE_COVER_FRONT = 3
+
+
+def read_syncsafe(data: bytes) -> int:
+    return sum((b & 0x7f) << (7 * i) for i, b in enumerate(reversed(data)))
+
+
+def write_syncsafe(n: int) -> bytes:
+    if n >= 1 << 28:
+        raise ValueError(n)
+    return bytes((n >> (7 * i)) & 0x7f for i in reversed(range(4)))
+
+
+def get_id3_size(header: bytes) -> int:
+    if header[:3] != b'ID3' or len(header) < 10:
+        return 0
+    return 10 + read_syncsafe(header[6:10]) + (10 if header[5] & 0x10 else 0)
+
+
+def create_id3_frame(id_: str, data: bytes) -> bytes:
+    return id_.encode('ascii') + write_syncsafe(len(data)) + b'\x00\x00' + data
+
+
+def create_id3_text_frame(id_: str, values: str | list[str]) -> bytes:
+    return create_id3_frame(id_, b'\x03' + '\x00'.join([values] if isinstance(values, str) else values).encode())
+
+
+def create_id3_txxx_frame(description: str, value: str) -> bytes:
+    return create_id3_frame('TXXX', b'\x03' + description.encode() + b'\x00' + value.encode())
+
+
+def create_id3_apic_frame(mime: str, type_: int, description: str, data: bytes) -> bytes:
+    return create_id3_frame('APIC', b'\x03' + mime.encode('latin-1') + b'\x00' + bytes([type_]) + description.encode() + b'\x00' + data)
+
+
+def write_id3_header(header: bytes, frames: list[bytes]) -> bytes:
+    # Replaces the ID3v2 tag at the start of `header` (if any) with an ID3v2.4 tag of `frames`,
+    # what follows the tag in `header` is kept as is.
+    size = sum(len(f) for f in frames) + ID3_PADDING
+    return b''.join([b'ID3\x04\x00\x00', write_syncsafe(size), *frames, bytes(ID3_PADDING), header[get_id3_size(header):]])
+
+
+def create_flac_block(type_: int, data: bytes, last: bool = False) -> bytes:
+    if len(data) >= 1 << 24:
+        raise ValueError(len(data))
+    return bytes([type_ | (0x80 if last else 0)]) + len(data).to_bytes(3, 'big') + data
+
+
+def create_flac_picture(type_: int, mime: str, description: str, width: int, height: int, depth: int, data: bytes) -> bytes:
+    mime = mime.encode('ascii')
+    description = description.encode()
+    return b''.join([
+        type_.to_bytes(4, 'big'),
+        len(mime).to_bytes(4, 'big'), mime,
+        len(description).to_bytes(4, 'big'), description,
+        width.to_bytes(4, 'big'), height.to_bytes(4, 'big'), depth.to_bytes(4, 'big'), bytes(4),
+        len(data).to_bytes(4, 'big'), data])
+
+
+def write_flac_header(header: bytes, comments: list[tuple[str, str]], pictures: list[bytes]) -> bytes:
+    # Keeps the metadata blocks of `header` (STREAMINFO, SEEKTABLE, ...) except tags, pictures and padding,
+    # which are replaced by `comments`, `pictures` and FLAC_PADDING bytes of padding.
+    if header[:4] != b'fLaC':
+        raise Exception(header[:4])
+
+    blocks = []
+    vendor = b'deezl'
+    i = 4
+    while i < len(header):
+        type_, size = header[i] & 0x7f, int.from_bytes(header[i + 1:i + 4], 'big')
+        data = header[i + 4:i + 4 + size]
+        if type_ == FLAC_VORBIS_COMMENT:
+            vendor = data[4:4 + int.from_bytes(data[:4], 'little')]
+        elif type_ not in (FLAC_PADDING_BLOCK, FLAC_PICTURE):
+            blocks.append((type_, data))
+        i += 4 + size
+        if header[i - 4 - size] & 0x80:
+            break
+
+    comments = [f'{k}={v}'.encode() for k, v in comments]
+    blocks.append((FLAC_VORBIS_COMMENT, b''.join([len(vendor).to_bytes(4, 'little'), vendor, len(comments).to_bytes(4, 'little'), *(len(c).to_bytes(4, 'little') + c for c in comments)])))
+    blocks.extend((FLAC_PICTURE, p) for p in pictures)
+    blocks.append((FLAC_PADDING_BLOCK, bytes(FLAC_PADDING)))
+
+    return b''.join([b'fLaC', *(create_flac_block(t, d, j == len(blocks) - 1) for j, (t, d) in enumerate(blocks)), header[i:]])
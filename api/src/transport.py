@@ -0,0 +1,135 @@
+import time
+import random
+import asyncio
+import email.utils
+import aiohttp
+from yarl import URL
+
+
+class CircuitOpenError(aiohttp.ClientConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened = None
+        self._probing = False
+
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened is None:
+            return 'closed'
+        return 'open' if self._probing or time.monotonic() < self._opened + self._reset_timeout else 'half-open'
+
+    def stats(self) -> dict:
+        return dict(state=self.state, failures=self._failures, trips=self.trips, rejected=self.rejected)
+
+    def acquire(self):
+        match self.state:
+            case 'open':
+                self.rejected += 1
+                raise CircuitOpenError()
+            case 'half-open':
+                self._probing = True
+
+    def abort(self):
+        self._probing = False
+
+    def release(self, success: bool):
+        self._probing = False
+        if success:
+            self._failures = 0
+            self._opened = None
+            return
+
+        self._failures += 1
+        if self._opened is not None or self._failures >= self._failure_threshold:
+            if self._opened is None:
+                self.trips += 1
+            self._opened = time.monotonic()
+
+
+class Transport:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, attempts: int = 4, backoff: float = 0.5, max_backoff: float = 30, failure_threshold: int = 5, reset_timeout: float = 30):
+        self._attempts = attempts
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._breakers = {}
+
+        self.retries = 0
+
+    def stats(self) -> dict:
+        return dict(retries=self.retries, hosts={host: breaker.stats() for host, breaker in self._breakers.items()})
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        if (breaker := self._breakers.get(host)) is None:
+            breaker = self._breakers[host] = CircuitBreaker(self._failure_threshold, self._reset_timeout)
+        return breaker
+
+    async def __call__(self, request: aiohttp.ClientRequest, handler) -> aiohttp.ClientResponse:
+        # Client middleware: every request of a session goes through the circuit breaker of its host,
+        # connection errors, timeouts and retryable statuses are retried with jittered exponential backoff.
+        breaker = self.breaker(request.url.host)
+        for i in range(self._attempts):
+            breaker.acquire()
+            try:
+                response = await handler(request)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                breaker.release(False)
+                if i == self._attempts - 1 or breaker.state == 'open':
+                    raise
+                delay = None
+            except BaseException:
+                breaker.abort()
+                raise
+            else:
+                breaker.release(response.status < 500)
+                if response.status not in self.RETRY_STATUSES or i == self._attempts - 1 or breaker.state == 'open':
+                    return response
+                delay = parse_retry_after(response.headers.get('Retry-After'))
+                response.release()
+
+            self.retries += 1
+            await asyncio.sleep(max(random.uniform(0, min(self._max_backoff, self._backoff * 2 ** i)), min(delay or 0, self._max_backoff)))
+
+
+def create_upstream_override(url: str):
+    # Client middleware sending every request to `url` instead (scheme, host and port), keeping the original
+    # Host header, so that a local stand-in server can tell which upstream was meant.
+    url = URL(url)
+
+    async def override(request: aiohttp.ClientRequest, handler) -> aiohttp.ClientResponse:
+        request.url = request.url.with_scheme(url.scheme).with_host(url.host).with_port(url.port)
+        return await handler(request)
+
+    return override
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def create_connector(limit: int, limit_per_host: int, keepalive_timeout: float, dns_cache_ttl: int) -> aiohttp.TCPConnector:
+    return aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=keepalive_timeout,
+        use_dns_cache=True,
+        ttl_dns_cache=dns_cache_ttl)
@@ -0,0 +1,78 @@
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Callable
+
+
+class WorkerPool:
+    # Worker processes are spawned rather than forked, so that they do not inherit the listening socket and signal
+    # handlers of the server, and they are waited for on shutdown.
+    EXECUTORS = dict(thread=ThreadPoolExecutor, process=functools.partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context('spawn')))
+
+    def __init__(self, type_: str, max_workers: int, max_queued: int):
+        self._executor: Executor = self.EXECUTORS[type_](max_workers=max_workers)
+        self._slots = asyncio.Semaphore(max_workers + max_queued)
+        self._max_workers = max_workers
+        self._max_queued = max_queued
+
+        self.submitted = 0
+        self.pending = 0
+        self.waiting = 0
+
+    def stats(self) -> dict:
+        return dict(max_workers=self._max_workers, max_queued=self._max_queued, submitted=self.submitted, pending=self.pending, waiting=self.waiting)
+
+    async def run(self, f: Callable, *args, **kwargs) -> Any:
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.submitted += 1
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(f, *args, **kwargs))
+        finally:
+            self.pending -= 1
+            self._slots.release()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class EventLoopMonitor:
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._task = None
+
+        self.samples = 0
+        self.lag_seconds = 0.0
+        self.max_lag_seconds = 0.0
+        self.total_lag_seconds = 0.0
+
+    def stats(self) -> dict:
+        return dict(
+            samples=self.samples,
+            lag_seconds=self.lag_seconds,
+            max_lag_seconds=self.max_lag_seconds,
+            mean_lag_seconds=self.total_lag_seconds / self.samples if self.samples else 0.0)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self._interval)
+            self.lag_seconds = max(loop.time() - start - self._interval, 0.0)
+            self.max_lag_seconds = max(self.max_lag_seconds, self.lag_seconds)
+            self.total_lag_seconds += self.lag_seconds
+            self.samples += 1
+
+    async def aclose(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
@@ -1,18 +1,3 @@
-function promisify(f) {
-  return (...args) => {
-    return new Promise((resolve, reject) => {
-      f.call(null, ...args, (err, res) => {
-        if (err) {
-          reject(err)
-        } else {
-          resolve(res)
-        }
-      })
-    })
-  }
-}
-
-
 import {format, parseISO, addSeconds} from 'date-fns'
 
 export function formatDate(s) {
@@ -24,11 +9,6 @@ export function formatSecondsDuration(seconds) {
 }
 
 
-import {zip as zip_} from 'fflate'
-
-export const zip = promisify(zip_)
-
-
 import {ref, onMounted, watchEffect} from 'vue'
 import {useResizeObserver} from '@vueuse/core'
 import {createPopper} from '@popperjs/core'
@@ -67,3 +47,22 @@ export function usePopper(options) {
 
   return [trigger, container]
 }
+
+
+export async function* readNdjson(response) {
+  const reader = response.body.pipeThrough(new TextDecoderStream()).getReader()
+  let buffer = ''
+  while (true) {
+    const {done, value} = await reader.read()
+    if (done) {
+      break
+    }
+
+    const lines = (buffer + value).split('\n')
+    buffer = lines.pop()
+    yield lines.filter((l) => l !== '').map((l) => JSON.parse(l))
+  }
+  if (buffer !== '') {
+    yield [JSON.parse(buffer)]
+  }
+}